@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+
+import argparse
+import concurrent.futures
+import http.client
+import json
+import os
+import random
+import resource
+import string
+import subprocess
+import sys
+import time
+import uuid
+
+import boto.s3
+import cherrypy
+import pymysql
+
+import db
+import fakes3
+import init
+import metrics
+import server
+
+# Runs the real API and sync against in-memory S3 buckets and a scratch MySQL
+# database, and reports throughput, latency percentiles and peak memory per
+# scenario. The database named with --database is wiped and recreated from
+# s3.sql, so never point it at one that holds anything of value. Results are
+# written as JSON together with the commit they were measured on; --compare
+# prints the change against an earlier run with the same parameters.
+
+# Maps random bytes onto the characters that S3Sync uses for keys.
+keyAlphabet = (string.ascii_letters + string.digits).encode('ascii')
+keyTable = bytes.maketrans(bytes(range(256)), bytes(keyAlphabet[byte % len(keyAlphabet)] for byte in range(256)))
+
+class Client():
+    def __init__(self, port):
+        self.port = port
+
+    def request(self, method, path, body=None, headers={}, keep=False):
+        # Returns (status, size, body); the body is only kept when asked for,
+        # downloads are counted and thrown away as they arrive.
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+        try:
+            connection.request(method, '/api/s3/1.0' + path, body=body, headers=headers)
+            response = connection.getresponse()
+            size = 0
+            chunks = []
+            while True:
+                chunk = response.read(1048576)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if keep:
+                    chunks.append(chunk)
+            return (response.status, size, b''.join(chunks))
+        finally:
+            connection.close()
+
+    def upload(self, content, mimeType='application/octet-stream'):
+        boundary = uuid.uuid4().hex
+        body = b''.join([b'--%s\r\n' % boundary.encode('ascii'),
+                         b'Content-Disposition: form-data; name="upload"; filename="benchmark.bin"\r\n',
+                         b'Content-Type: %s\r\n\r\n' % mimeType.encode('ascii'),
+                         content,
+                         b'\r\n--%s--\r\n' % boundary.encode('ascii')])
+        (status, size, text) = self.request('POST', '/upload', body, {'Content-Type': 'multipart/form-data; boundary=%s' % boundary}, keep=True)
+        if status != 200:
+            raise Exception('Upload failed with %d' % status)
+        key = text.decode('utf-8').split('<span id="key">')[1].split('</span>')[0]
+        (status, size, text) = self.request('PUT', '/upload', json.dumps({'key': key}).encode('utf-8'), {'Content-Type': 'application/json'})
+        if status != 200:
+            raise Exception('Confirmation failed with %d' % status)
+        return key
+
+    def download(self, key):
+        (status, size, text) = self.request('GET', '/download/%s' % key)
+        if status != 200:
+            raise Exception('Download failed with %d' % status)
+        return size
+
+    def get(self, key):
+        (status, size, text) = self.request('GET', '/object/%s' % key)
+        if status != 200:
+            raise Exception('Get failed with %d' % status)
+        return size
+
+    def list(self):
+        (status, size, text) = self.request('GET', '/list?limit=100')
+        if status != 200:
+            raise Exception('List failed with %d' % status)
+        return size
+
+class Benchmark():
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+        self.connections = {}
+        self.bucketMemory = 0
+
+    def setUp(self):
+        cherrypy.config.update(self.args.config)
+        cherrypy.config.update({'database.name': self.args.database,
+                                'server.socket_host': '127.0.0.1',
+                                'server.socket_port': self.args.port,
+                                'log.screen': False,
+                                'log.access_file': '',
+                                'log.error_file': '',
+                                'engine.autoreload.on': False,
+                                'checker.on': False})
+        self.createSchema()
+
+        # Both buckets live in this process; connect_to_region hands out the
+        # fake connection that belongs to the configured bucket.
+        providers = {cherrypy.config['s3.pri.bucket']: 'pri', cherrypy.config['s3.sec.bucket']: 'sec'}
+        for provider in ['pri', 'sec']:
+            self.connections[provider] = fakes3.FakeS3(latency=getattr(self.args, '%sLatency' % provider),
+                                                       bandwidth=getattr(self.args, '%sBandwidth' % provider),
+                                                       failureRate=getattr(self.args, '%sFailures' % provider))
+        boto.s3.connect_to_region = lambda region, **kwargs: BucketRouter(self.connections, providers)
+
+        self.api = server.API()
+        apiConfig = {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+                           'tools.gzip.mime_types': ['text/*', 'application/*'],
+                           'tools.gzip.on': True}}
+        cherrypy.tree.mount(self.api, '/api/s3/1.0', config=apiConfig)
+        cherrypy.engine.subscribe('start_thread', init.Init.assignDatabaseParameters)
+        cherrypy.engine.start()
+        cherrypy.thread_data.db = init.Init.databaseParameters()
+        self.client = Client(self.args.port)
+
+    def tearDown(self):
+        cherrypy.engine.exit()
+
+    def createSchema(self):
+        parameters = init.Init.databaseParameters()['parameters']
+        connection = pymysql.connect(autocommit=True, **dict(parameters, db=None))
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('DROP DATABASE IF EXISTS `%s`' % self.args.database)
+                cursor.execute('CREATE DATABASE `%s`' % self.args.database)
+                cursor.execute('USE `%s`' % self.args.database)
+                with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 's3.sql')) as fp:
+                    schema = '\n'.join(line for line in fp if not line.startswith('--'))
+                for statement in schema.split(';'):
+                    if statement.strip():
+                        cursor.execute(statement)
+        finally:
+            connection.close()
+
+    def reset(self):
+        # Keys reserved in the pool belong to rows that are about to go.
+        with self.api.s3.keyPoolLock:
+            self.api.s3.keyPool.clear()
+        with db.DatabaseCursor() as cursor:
+            for table in ['objects', 'journal', 'syncState', 'blobs', 'syncLeases']:
+                cursor.execute('DELETE FROM `%s`' % table)
+        for connection in self.connections.values():
+            for bucket in connection.buckets.values():
+                bucket.clear()
+
+    def run(self):
+        self.setUp()
+        try:
+            for scenario in self.args.scenarios:
+                getattr(self, 'scenario%s' % scenario.capitalize())()
+        finally:
+            self.tearDown()
+
+    def measure(self, name, function, items, concurrency, size=None):
+        # Runs function over items on concurrency threads and records one
+        # result line. Latencies are per call, as seen by the client.
+        latencies = []
+        errors = 0
+        self.resetPeak()
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [pool.submit(self.timed, function, item) for item in items]
+            for future in futures:
+                (latency, error) = future.result()
+                latencies.append(latency)
+                if error:
+                    errors += 1
+        elapsed = time.time() - start
+        latencies.sort()
+        result = {'scenario': name, 'concurrency': concurrency, 'requests': len(items), 'errors': errors,
+                  'seconds': round(elapsed, 3),
+                  'requestsPerSecond': round(len(items) / elapsed, 2) if elapsed else None,
+                  'p50': round(self.percentile(latencies, 50), 4),
+                  'p99': round(self.percentile(latencies, 99), 4),
+                  'peakRSS': self.peakRSS()}
+        if size:
+            result['megabytesPerSecond'] = round(size * len(items) / elapsed / 1048576, 2) if elapsed else None
+        self.report(result)
+        return result
+
+    def timed(self, function, item):
+        start = time.time()
+        try:
+            function(item)
+            return (time.time() - start, None)
+        except Exception as e:
+            return (time.time() - start, e)
+
+    def percentile(self, values, percent):
+        if not values:
+            return 0
+        return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+    def resetPeak(self):
+        # Linux lets the high-water mark be reset, so that every result gets a
+        # peak of its own instead of the largest one of the run so far.
+        self.bucketMemory = self.fakeMemory()
+        try:
+            with open('/proc/self/clear_refs', 'w') as fp:
+                fp.write('5')
+        except (IOError, OSError):
+            pass
+
+    def peakRSS(self):
+        # High-water mark of the whole process (client and server) in MB
+        # since resetPeak(), less what the fake buckets hold at their largest:
+        # a real deployment keeps that in S3.
+        peak = None
+        try:
+            with open('/proc/self/status') as fp:
+                for line in fp:
+                    if line.startswith('VmHWM:'):
+                        peak = int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            pass
+        if peak is None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return round((peak - max(self.bucketMemory, self.fakeMemory())) / 1048576.0, 1)
+
+    def fakeMemory(self):
+        return sum(bucket.memory() for connection in self.connections.values() for bucket in list(connection.buckets.values()))
+
+    def report(self, result):
+        self.results.append(result)
+        print('%-24s c=%-3d %8s req/s  p50 %8.4fs  p99 %8.4fs  errors %-5d peak RSS %8.1f MB%s' %
+              (result['scenario'], result['concurrency'], result['requestsPerSecond'], result['p50'], result['p99'], result['errors'], result['peakRSS'],
+               '  %.2f MB/s' % result['megabytesPerSecond'] if result.get('megabytesPerSecond') else ''))
+        sys.stdout.flush()
+
+    def upload(self, size, count, concurrency):
+        return [key for key in self.parallel(lambda i: self.client.upload(os.urandom(size)), range(count), concurrency) if key]
+
+    def parallel(self, function, items, concurrency):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(function, items))
+
+    def scenarioUpload(self):
+        content = os.urandom(self.args.size)
+        for concurrency in self.args.concurrency:
+            self.reset()
+            self.measure('upload', lambda i: self.client.upload(content), range(self.args.requests), concurrency, size=self.args.size)
+
+    def scenarioDownload(self):
+        self.reset()
+        keys = self.upload(self.args.size, min(self.args.requests, 1000), max(self.args.concurrency))
+        for concurrency in self.args.concurrency:
+            self.measure('download', self.client.download, [random.choice(keys) for i in range(self.args.requests)], concurrency, size=self.args.size)
+            self.measure('get', self.client.get, [random.choice(keys) for i in range(self.args.requests)], concurrency, size=self.args.size)
+
+    def scenarioList(self):
+        self.reset()
+        self.upload(1024, 1000, max(self.args.concurrency))
+        for concurrency in self.args.concurrency:
+            self.measure('list', lambda i: self.client.list(), range(self.args.requests), concurrency)
+
+    def scenarioLarge(self):
+        self.reset()
+        content = os.urandom(self.args.largeSize)
+        count = max(4, max(self.args.concurrency))
+        for concurrency in self.args.concurrency:
+            keys = []
+            self.measure('large-upload', lambda i: keys.append(self.client.upload(content)), range(count), concurrency, size=self.args.largeSize)
+            self.measure('large-download', self.client.download, keys, concurrency, size=self.args.largeSize)
+
+    def scenarioSync(self):
+        # Every object exists in the primary bucket only, or has expired, and
+        # sync passes run back to back until the backlog is gone.
+        for backlog in self.args.backlog:
+            for kind in ['replicate', 'expire']:
+                self.reset()
+                self.seed(backlog, kind)
+                self.resetPeak()
+                passes = []
+                left = backlog
+                stalled = 0
+                start = time.time()
+                while left and len(passes) < self.args.maxPasses and stalled < 3:
+                    passStart = time.time()
+                    self.api.s3.sync()
+                    passes.append(time.time() - passStart)
+                    (before, left) = (left, self.backlog(kind))
+                    stalled = stalled + 1 if left == before else 0
+                elapsed = time.time() - start
+                if left:
+                    # A scenario that does not drain measures nothing useful,
+                    # so say so rather than report a throughput for it.
+                    print('sync-%s-%d: %d of %d keys still left after %d passes' % (kind, backlog, left, backlog, len(passes)))
+                passes.sort()
+                self.report({'scenario': 'sync-%s-%d' % (kind, backlog), 'concurrency': 1, 'requests': backlog,
+                             'errors': left, 'seconds': round(elapsed, 3),
+                             'requestsPerSecond': round(backlog / elapsed, 2) if elapsed else None,
+                             'p50': round(self.percentile(passes, 50), 4), 'p99': round(self.percentile(passes, 99), 4),
+                             'passes': len(passes), 'peakRSS': self.peakRSS()})
+
+    def seed(self, count, kind):
+        content = b'x' * 1024
+        for offset in range(0, count, 5000):
+            keys = [os.urandom(256).translate(keyTable).decode('ascii') for i in range(offset, min(count, offset + 5000))]
+            with db.DatabaseCursor() as cursor:
+                if kind == 'replicate':
+                    cursor.execute('INSERT INTO `objects` (`key`, `user`, `name`, `mimeType`, `pri`, `sec`) VALUES %s' % ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(keys)),
+                                   [value for key in keys for value in (key, 'benchmark', 'seed', 'application/octet-stream', True, False)])
+                else:
+                    cursor.execute('INSERT INTO `objects` (`key`, `user`, `name`, `mimeType`, `pri`, `sec`, `deleteAfter`) VALUES %s' % ', '.join(['(%s, %s, %s, %s, %s, %s, DATE_SUB(NOW(), INTERVAL 1 DAY))'] * len(keys)),
+                                   [value for key in keys for value in (key, 'benchmark', 'seed', 'application/octet-stream', True, True)])
+            for provider in (['pri'] if kind == 'replicate' else ['pri', 'sec']):
+                self.bucket(provider).seed((key, content) for key in keys)
+
+    def backlog(self, kind):
+        with db.DatabaseCursor() as cursor:
+            if kind == 'replicate':
+                cursor.execute('SELECT COUNT(*) AS `count` FROM `objects` WHERE `sec` = %s', (False,))
+            else:
+                cursor.execute('SELECT COUNT(*) AS `count` FROM `objects` WHERE `deleteAfter` IS NOT NULL')
+            return cursor.fetchone()['count']
+
+    def bucket(self, provider):
+        return self.connections[provider].get_bucket(cherrypy.config['s3.%s.bucket' % provider])
+
+    def save(self):
+        parameters = dict((name, value) for (name, value) in vars(self.args).items() if name not in ['config', 'output', 'compare', 'port', 'database'])
+        output = {'commit': commit(), 'started': time.strftime('%Y-%m-%d %H:%M:%S'), 'parameters': parameters,
+                  'results': self.results, 'metrics': metrics.registry.render()}
+        with open(self.args.output, 'w') as fp:
+            json.dump(output, fp, indent=2)
+
+    def compare(self):
+        with open(self.args.compare) as fp:
+            baseline = json.load(fp)
+        parameters = dict((name, value) for (name, value) in vars(self.args).items() if name not in ['config', 'output', 'compare', 'port', 'database'])
+        if baseline['parameters'] != parameters:
+            print('Warning: %s was measured with different parameters' % self.args.compare)
+        print('Compared with %s (commit %s):' % (self.args.compare, baseline['commit']))
+        before = dict(((result['scenario'], result['concurrency']), result) for result in baseline['results'])
+        for result in self.results:
+            old = before.get((result['scenario'], result['concurrency']))
+            if not old:
+                continue
+            print('%-24s c=%-3d req/s %+7.1f%%  p50 %+7.1f%%  p99 %+7.1f%%  peak RSS %+7.1f%%' %
+                  (result['scenario'], result['concurrency'], change(old['requestsPerSecond'], result['requestsPerSecond']),
+                   change(old['p50'], result['p50']), change(old['p99'], result['p99']), change(old['peakRSS'], result['peakRSS'])))
+
+class BucketRouter():
+    def __init__(self, connections, providers):
+        self.connections = connections
+        self.providers = providers
+
+    def get_bucket(self, name):
+        return self.connections[self.providers[name]].get_bucket(name)
+
+def change(old, new):
+    return (float(new) - old) * 100 / old if old and new is not None else 0.0
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(usage='usage: %s --database NAME [options]' % os.path.basename(__file__))
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini'), help='Path to config.ini for database and s3 settings')
+    parser.add_argument('--database', required=True, help='Scratch database to create the schema in; it is dropped first')
+    parser.add_argument('--port', type=int, default=8089, help='Port for the API under test')
+    parser.add_argument('--scenarios', nargs='+', default=['upload', 'download', 'list', 'large', 'sync'], choices=['upload', 'download', 'list', 'large', 'sync'])
+    parser.add_argument('--requests', type=int, default=1000, help='Requests per scenario and concurrency')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--size', type=int, default=65536, help='Object size for upload and download')
+    parser.add_argument('--largeSize', type=int, default=33554432, help='Object size for the large object scenario')
+    parser.add_argument('--backlog', type=int, nargs='+', default=[10000, 100000, 1000000], help='Number of keys behind for the sync scenarios')
+    parser.add_argument('--maxPasses', type=int, default=1000, help='Give up on a sync backlog after this many passes')
+    for provider in ['pri', 'sec']:
+        parser.add_argument('--%sLatency' % provider, type=float, default=0.02, help='Seconds added to every request to the bucket')
+        parser.add_argument('--%sBandwidth' % provider, type=float, default=None, help='Bytes per second for transfers to and from the bucket')
+        parser.add_argument('--%sFailures' % provider, type=float, default=0.0, help='Fraction of requests to the bucket that fail')
+    parser.add_argument('--output', default='benchmark.json', help='Where to write the results')
+    parser.add_argument('--compare', help='Results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    benchmark = Benchmark(args)
+    benchmark.run()
+    benchmark.save()
+    if args.compare:
+        benchmark.compare()
+
+if __name__ == '__main__':
+    sys.exit(main())
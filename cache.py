@@ -0,0 +1,146 @@
+import collections
+import hashlib
+import os
+import threading
+
+class ObjectCache():
+    """
+    Read-through cache for object contents, keyed by object key. Objects never
+    change once they have been stored, so entries only leave the cache when
+    they are evicted to stay within the size budgets or when the object is
+    deleted. Recently used entries are kept in memory, and every entry is
+    also written to the cache directory if one is configured.
+    """
+    def __init__(self, memorySize=0, diskSize=0, directory=None, maxObjectSize=16777216):
+        self.memorySize = memorySize
+        self.diskSize = diskSize if directory else 0
+        self.directory = directory
+        self.maxObjectSize = maxObjectSize
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()
+        self.memoryUsed = 0
+        self.disk = collections.OrderedDict()
+        self.diskUsed = 0
+        self.counters = {'hits': 0, 'misses': 0, 'memoryHits': 0, 'diskHits': 0, 'stores': 0, 'evictions': 0, 'invalidations': 0}
+
+        if self.diskSize:
+            # Pick up whatever a previous run left behind, oldest access first.
+            os.makedirs(self.directory, exist_ok=True)
+            entries = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.endswith('.tmp'):
+                    os.unlink(path)
+                    continue
+                entries.append((os.stat(path).st_atime, name, os.stat(path).st_size))
+            for (atime, name, size) in sorted(entries):
+                self.disk[name] = size
+                self.diskUsed += size
+            with self.lock:
+                self._evict()
+
+    def get(self, key):
+        name = self._name(key)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.counters['hits'] += 1
+                self.counters['memoryHits'] += 1
+                return self.memory[key]
+            if name not in self.disk:
+                self.counters['misses'] += 1
+                return None
+            self.disk.move_to_end(name)
+
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as fp:
+                content = fp.read()
+        except OSError:
+            with self.lock:
+                if name in self.disk:
+                    self.diskUsed -= self.disk.pop(name)
+                self.counters['misses'] += 1
+            return None
+
+        with self.lock:
+            self.counters['hits'] += 1
+            self.counters['diskHits'] += 1
+            self._remember(key, content)
+        return content
+
+    def put(self, key, content):
+        if len(content) > self.maxObjectSize:
+            return
+        name = self._name(key)
+        if self.diskSize and len(content) <= self.diskSize:
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path + '.tmp', 'wb') as fp:
+                    fp.write(content)
+                os.replace(path + '.tmp', path)
+            except OSError:
+                pass
+            else:
+                with self.lock:
+                    if name in self.disk:
+                        self.diskUsed -= self.disk.pop(name)
+                    self.disk[name] = len(content)
+                    self.diskUsed += len(content)
+
+        with self.lock:
+            self.counters['stores'] += 1
+            self._remember(key, content)
+            self._evict()
+
+    def invalidate(self, key):
+        name = self._name(key)
+        with self.lock:
+            found = False
+            if key in self.memory:
+                self.memoryUsed -= len(self.memory.pop(key))
+                found = True
+            if name in self.disk:
+                self.diskUsed -= self.disk.pop(name)
+                found = True
+            if found:
+                self.counters['invalidations'] += 1
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except (OSError, TypeError):
+            pass
+
+    def statistics(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({'memoryEntries': len(self.memory), 'memoryUsed': self.memoryUsed, 'memorySize': self.memorySize,
+                          'diskEntries': len(self.disk), 'diskUsed': self.diskUsed, 'diskSize': self.diskSize})
+        return stats
+
+    def _remember(self, key, content):
+        # Caller holds self.lock.
+        if len(content) > self.memorySize:
+            return
+        if key in self.memory:
+            self.memoryUsed -= len(self.memory.pop(key))
+        self.memory[key] = content
+        self.memoryUsed += len(content)
+        self._evict()
+
+    def _evict(self):
+        # Caller holds self.lock.
+        while self.memoryUsed > self.memorySize:
+            (key, content) = self.memory.popitem(last=False)
+            self.memoryUsed -= len(content)
+            self.counters['evictions'] += 1
+        while self.diskUsed > self.diskSize:
+            (name, size) = self.disk.popitem(last=False)
+            self.diskUsed -= size
+            self.counters['evictions'] += 1
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def _name(self, key):
+        # Keys are longer than most filesystems allow for a file name.
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
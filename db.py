@@ -1,7 +1,127 @@
 import cherrypy
 import pymysql
+import threading
 import time
 
+import metrics
+
+class ConnectionPool():
+    """
+    A bounded set of database connections shared between all threads. Idle
+    connections are only checked with a ping when they have not been used for
+    idleCheck seconds, and they run in driver autocommit mode so that no
+    separate COMMIT has to be sent after every statement.
+    """
+    def __init__(self, parameters, size=20, idleCheck=30):
+        self.parameters = parameters
+        self.size = size
+        self.idleCheck = idleCheck
+        self.lock = threading.Condition()
+        self.idle = []
+        self.open = 0
+        self.counters = {'acquired': 0, 'waited': 0, 'waitTime': 0.0, 'maxWaitTime': 0.0, 'connected': 0, 'pinged': 0, 'discarded': 0}
+
+    def acquire(self, fresh=False):
+        # Returns (connection, checked), where checked tells whether the
+        # connection is new or has just answered a ping. An idle connection
+        # that fails its ping has died while it was idle, after a server
+        # restart or wait_timeout for instance, and is replaced straight
+        # away; only failing to connect is an error.
+        start = time.time()
+        with self.lock:
+            while not self.idle and self.open >= self.size:
+                self.lock.wait()
+            stale = None
+            if self.idle and not fresh:
+                (connection, lastUsed) = self.idle.pop()
+            else:
+                if self.open >= self.size:
+                    # A fresh connection takes the slot of the idle one that
+                    # has gone unused the longest.
+                    (stale, lastUsed) = self.idle.pop(0)
+                    self.counters['discarded'] += 1
+                else:
+                    self.open += 1
+                (connection, lastUsed) = (None, None)
+            waited = time.time() - start
+            self.counters['acquired'] += 1
+            if waited > 0.001:
+                self.counters['waited'] += 1
+            self.counters['waitTime'] += waited
+            self.counters['maxWaitTime'] = max(self.counters['maxWaitTime'], waited)
+        metrics.registry.observe('db_pool_wait_seconds', None, waited)
+        self._close(stale)
+
+        if connection is not None and time.time() - lastUsed > self.idleCheck:
+            try:
+                connection.ping(reconnect=False)
+                with self.lock:
+                    self.counters['pinged'] += 1
+                return (connection, True)
+            except Exception:
+                # The slot is kept for the replacement below.
+                self._close(connection)
+                connection = None
+                with self.lock:
+                    self.counters['pinged'] += 1
+                    self.counters['discarded'] += 1
+        elif connection is not None:
+            return (connection, False)
+
+        try:
+            connection = pymysql.connect(autocommit=True, **self.parameters)
+            with self.lock:
+                self.counters['connected'] += 1
+        except Exception:
+            self.discard(None)
+            raise
+        return (connection, True)
+
+    def release(self, connection):
+        with self.lock:
+            self.idle.append((connection, time.time()))
+            self.lock.notify()
+
+    def discard(self, connection):
+        self._close(connection)
+        with self.lock:
+            self.open -= 1
+            self.counters['discarded'] += 1
+            self.lock.notify()
+
+    def _close(self, connection):
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def statistics(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({'size': self.size, 'open': self.open, 'idle': len(self.idle), 'inUse': self.open - len(self.idle)})
+        return stats
+
+pool = None
+poolLock = threading.Lock()
+
+def configurePool(parameters, size=20, idleCheck=30):
+    global pool
+    with poolLock:
+        pool = ConnectionPool(parameters, size=size, idleCheck=idleCheck)
+
+def getPool():
+    # Threads started by CherryPy carry the connection parameters in
+    # thread_data, which is enough to set up the pool if nobody else did.
+    global pool
+    with poolLock:
+        if pool is None:
+            pool = ConnectionPool(cherrypy.thread_data.db['parameters'])
+        return pool
+
+def statistics():
+    return pool.statistics() if pool else None
+
 class DatabaseCursor():
     def __init__(self, cursorClass=pymysql.cursors.DictCursor, maxErrors=5, autoCommit=True, logQueries=False):
         self.errorCount = 0
@@ -11,13 +131,25 @@ class DatabaseCursor():
         self.logQueries = logQueries
 
     def __enter__(self):
-        self.cursor = self.testConnection()
+        self.cursor = self.acquireConnection()
         return self
 
     def __exit__(self, type, value, traceback):
-        if self.autoCommit:
-            self.cursor.execute('COMMIT')
-        self.cursor.close()
+        broken = isinstance(value, (pymysql.err.OperationalError, pymysql.err.InterfaceError))
+        try:
+            self.cursor.close()
+            if not self.autoCommit and not broken:
+                if type is None:
+                    self.connection.commit()
+                else:
+                    self.connection.rollback()
+                self.connection.autocommit(True)
+        except Exception:
+            broken = True
+        if broken:
+            self.pool.discard(self.connection)
+        else:
+            self.pool.release(self.connection)
 
     def __iter__(self):
         return self.cursor.__iter__()
@@ -25,20 +157,18 @@ class DatabaseCursor():
     def next(self):
         return self.cursor.next()
 
-    def connectToDatabase(self):
-        return pymysql.connect(cursorclass=self.cursorClass, **cherrypy.thread_data.db['parameters'])
-
-    def testConnection(self):
-        if not cherrypy.thread_data.db['parameters']:
-            return None
-
+    def acquireConnection(self, fresh=False):
+        self.pool = getPool()
         while True:
             try:
-                if 'connection' not in cherrypy.thread_data.db:
-                    cherrypy.thread_data.db['connection'] = self.connectToDatabase()
-                cursor = cherrypy.thread_data.db['connection'].cursor()
-                cursor.execute('SELECT 0')
-                cursor.fetchall()
+                (self.connection, self.checked) = self.pool.acquire(fresh=fresh)
+                try:
+                    if not self.autoCommit:
+                        self.connection.autocommit(False)
+                    cursor = self.connection.cursor(self.cursorClass)
+                except Exception:
+                    self.pool.discard(self.connection)
+                    raise
                 if self.errorCount > 0:
                     cherrypy.log(msg='Database connection restored', context='MYSQL')
                     self.errorCount = 0
@@ -48,22 +178,46 @@ class DatabaseCursor():
                 cherrypy.log(msg='%s failure%s: %s' % (self.errorCount, '' if self.errorCount == 1 else 's', str(e)), context='MYSQL')
                 if self.maxErrors is not None and self.errorCount == self.maxErrors:
                     raise
-                if 'connection' in cherrypy.thread_data.db:
-                    try:
-                        cherrypy.thread_data.db['connection'].close()
-                    except:
-                        pass
-                    del cherrypy.thread_data.db['connection']
                 time.sleep(2)
         return cursor
 
     def execute(self, *args, **kwargs):
         start = time.time()
-        rc = self.cursor.execute(*args, **kwargs)
+        labels = {'statement': metrics.statement(args[0])}
+        try:
+            try:
+                rc = self.cursor.execute(*args, **kwargs)
+            except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+                # A pooled connection that was reused without a ping may have
+                # died since it was last used. Nothing has run on it yet, so
+                # the statement is safe to repeat once on a new connection.
+                if self.checked or not self.lost(e):
+                    raise
+                self.reconnect()
+                rc = self.cursor.execute(*args, **kwargs)
+            self.checked = True
+        except Exception:
+            metrics.registry.increment('sql_statement_errors_total', labels)
+            raise
+        finally:
+            metrics.registry.observe('sql_statement_seconds', labels, time.time() - start)
         if self.logQueries:
             cherrypy.log(msg='%.3fs: %s' % (time.time()-start, args), context='CURSOR-EXECUTE')
         return rc
 
+    def lost(self, error):
+        # Server gone away, lost connection during query, or a connection
+        # pymysql already knows to be closed.
+        return isinstance(error, pymysql.err.InterfaceError) or (error.args and error.args[0] in (2006, 2013, 2055))
+
+    def reconnect(self):
+        try:
+            self.cursor.close()
+        except Exception:
+            pass
+        self.pool.discard(self.connection)
+        self.cursor = self.acquireConnection(fresh=True)
+
     def fetchall(self, *args, **kwargs):
         start = time.time()
         rc = self.cursor.fetchall(*args, **kwargs)
@@ -83,4 +237,3 @@ class DatabaseCursor():
 
     def rowcount(self):
         return self.cursor.rowcount
-
@@ -0,0 +1,221 @@
+import bisect
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+class FakeS3Error(Exception):
+    def __init__(self, code, message):
+        super(FakeS3Error, self).__init__('%s: %s' % (code, message))
+        self.code = code
+        self.message = message
+
+class FakeS3():
+    """
+    In-memory stand-in for the part of a boto S3 connection that S3Sync uses.
+    Every request waits for latency seconds (plus the transfer time when a
+    bandwidth in bytes per second is given) and fails with probability
+    failureRate, so that slow or flaky buckets can be reproduced locally.
+    """
+    def __init__(self, latency=0, bandwidth=None, failureRate=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failureRate = failureRate
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.counters = {'requests': 0, 'failures': 0, 'bytesIn': 0, 'bytesOut': 0}
+
+    def get_bucket(self, name):
+        with self.lock:
+            if name not in self.buckets:
+                self.buckets[name] = FakeBucket(self, name)
+            return self.buckets[name]
+
+    def statistics(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def request(self, bytesIn=0, bytesOut=0):
+        with self.lock:
+            self.counters['requests'] += 1
+            self.counters['bytesIn'] += bytesIn
+            self.counters['bytesOut'] += bytesOut
+        delay = self.latency
+        if self.bandwidth:
+            delay += float(bytesIn + bytesOut) / self.bandwidth
+        if delay:
+            time.sleep(delay)
+        if self.failureRate and random.random() < self.failureRate:
+            with self.lock:
+                self.counters['failures'] += 1
+            raise FakeS3Error('InternalError', 'Injected failure')
+
+class FakeBucket():
+    """
+    Objects are kept in a dictionary together with a sorted list of their
+    names, so that listing a large bucket page by page stays cheap.
+    """
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.names = []
+
+    def get_key(self, name):
+        self.connection.request()
+        with self.lock:
+            if name not in self.objects:
+                return None
+        return FakeKey(self, name)
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def delete_key(self, name):
+        self.connection.request()
+        with self.lock:
+            self._remove(name)
+
+    def delete_keys(self, names, quiet=False):
+        self.connection.request()
+        result = FakeDeleteResult()
+        with self.lock:
+            for name in names:
+                self._remove(name)
+                result.deleted.append(FakeKey(self, name))
+        return result
+
+    def list(self, marker=''):
+        # Pages of 1000 keys, each one a request, like the real listing.
+        while True:
+            self.connection.request()
+            with self.lock:
+                start = bisect.bisect_right(self.names, marker)
+                names = self.names[start:start + 1000]
+            for name in names:
+                yield FakeKey(self, name)
+            if len(names) < 1000:
+                return
+            marker = names[-1]
+
+    def initiate_multipart_upload(self, name):
+        self.connection.request()
+        return FakeMultipartUpload(self, name)
+
+    def seed(self, items):
+        # Stores (name, content) pairs directly, without request costs.
+        with self.lock:
+            self.objects.update(items)
+            self.names = sorted(self.objects)
+
+    def clear(self):
+        with self.lock:
+            self.objects.clear()
+            self.names = []
+
+    def store(self, name, content):
+        with self.lock:
+            if name not in self.objects:
+                bisect.insort(self.names, name)
+            self.objects[name] = content
+
+    def memory(self):
+        # Approximate bytes held for the objects; content shared between keys,
+        # as seeded by the benchmark, is counted once.
+        with self.lock:
+            contents = dict((id(content), content) for content in self.objects.values())
+            return (sys.getsizeof(self.objects) + sys.getsizeof(self.names) + sum(sys.getsizeof(name) for name in self.names) +
+                    sum(sys.getsizeof(content) for content in contents.values()))
+
+    def _remove(self, name):
+        # Caller holds self.lock.
+        if self.objects.pop(name, None) is not None:
+            del self.names[bisect.bisect_left(self.names, name)]
+
+class FakeKey():
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.key = name
+        self.fp = None
+
+    @property
+    def size(self):
+        with self.bucket.lock:
+            return len(self.bucket.objects.get(self.name, b''))
+
+    def get_contents_as_string(self):
+        content = self._content()
+        self.bucket.connection.request(bytesOut=len(content))
+        return content
+
+    def set_contents_from_string(self, content):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        self.bucket.connection.request(bytesIn=len(content))
+        self.bucket.store(self.name, content)
+
+    def open_read(self, headers=None):
+        content = self._content()
+        if headers and 'Range' in headers:
+            (start, end) = headers['Range'].split('=')[1].split('-')
+            content = content[int(start):int(end) + 1]
+        self.bucket.connection.request()
+        self.fp = [content, 0]
+
+    def read(self, size):
+        # Like boto, the body is opened on the first read if open_read() has
+        # not been called. The transfer time is paid chunk by chunk, as the
+        # body streams in.
+        if self.fp is None:
+            self.open_read()
+        (content, offset) = self.fp
+        chunk = content[offset:offset + size]
+        self.fp[1] += len(chunk)
+        if chunk and self.bucket.connection.bandwidth:
+            time.sleep(float(len(chunk)) / self.bucket.connection.bandwidth)
+        return chunk
+
+    def close(self, fast=False):
+        self.fp = None
+
+    def generate_url(self, expires_in, method='GET', headers=None, response_headers=None):
+        query = dict(response_headers or {}, Expires=int(time.time()) + expires_in, Method=method)
+        return 'https://%s.s3.invalid/%s?%s' % (self.bucket.name, urllib.parse.quote(self.name), urllib.parse.urlencode(query))
+
+    def _content(self):
+        with self.bucket.lock:
+            if self.name not in self.bucket.objects:
+                raise FakeS3Error('NoSuchKey', 'The specified key does not exist.')
+            return self.bucket.objects[self.name]
+
+class FakeMultipartUpload():
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.lock = threading.Lock()
+        self.parts = {}
+
+    def upload_part_from_file(self, fp, part_num):
+        content = fp.read()
+        self.bucket.connection.request(bytesIn=len(content))
+        with self.lock:
+            self.parts[part_num] = content
+
+    def complete_upload(self):
+        self.bucket.connection.request()
+        with self.lock:
+            content = b''.join(self.parts[number] for number in sorted(self.parts))
+        self.bucket.store(self.name, content)
+
+    def cancel_upload(self):
+        self.bucket.connection.request()
+        with self.lock:
+            self.parts.clear()
+
+class FakeDeleteResult():
+    def __init__(self):
+        self.deleted = []
+        self.errors = []
@@ -0,0 +1,116 @@
+import collections
+import threading
+import time
+
+class ProviderHealth():
+    """
+    Rolling latency and error statistics for one bucket, together with a
+    circuit breaker. The circuit opens once at least failureRate of the
+    requests in the window failed, stays open for openTime seconds and then
+    lets a single probe request through: the circuit closes if it succeeds
+    and opens again if it fails. Other requests that finish in the meantime,
+    such as those already in flight when it opened, leave the state alone.
+    Latencies are kept per operation, so that slow part uploads do not
+    stretch the percentiles that reads are hedged on.
+    """
+    def __init__(self, window=60, failureRate=0.5, minRequests=10, openTime=30):
+        self.window = window
+        self.failureRate = failureRate
+        self.minRequests = minRequests
+        self.openTime = openTime
+        self.lock = threading.Lock()
+        self.samples = collections.deque()
+        self.failures = 0
+        self.state = 'closed'
+        self.openedAt = None
+        self.probing = None
+        self.percentiles = {}
+
+    def record(self, latency, ok, operation=None, probe=None):
+        # probe is what allow() returned for the probe request, if this is it.
+        now = time.time()
+        with self.lock:
+            self.samples.append((now, latency, ok, operation))
+            if not ok:
+                self.failures += 1
+            self._trim(now)
+            if self.state != 'closed':
+                if probe is None or probe != self.probing:
+                    return
+                self.probing = None
+                if ok:
+                    self.state = 'closed'
+                    self.samples.clear()
+                    self.failures = 0
+                else:
+                    self.state = 'open'
+                    self.openedAt = now
+            elif len(self.samples) >= self.minRequests and self.failures >= self.failureRate * len(self.samples):
+                self.state = 'open'
+                self.openedAt = now
+
+    def available(self):
+        # Whether a request would be let through, without taking the probe.
+        with self.lock:
+            return self._allowed(time.time())
+
+    def allow(self):
+        # Called before sending a request that may be skipped. Past openTime
+        # the circuit goes half-open and this request becomes the probe; no
+        # other is allowed until its outcome has been recorded. Returns False,
+        # True, or for the probe the ticket to pass on to record().
+        now = time.time()
+        with self.lock:
+            if not self._allowed(now):
+                return False
+            if self.state != 'closed':
+                self.state = 'half-open'
+                self.probing = now
+                return now
+            return True
+
+    def errorRate(self):
+        with self.lock:
+            self._trim(time.time())
+            return float(self.failures) / len(self.samples) if self.samples else 0.0
+
+    def percentile(self, percent, default=None, operation=None):
+        # Sorting the window for every read would be wasteful, so each
+        # percentile is recomputed at most once a second. Without an
+        # operation, all of them are taken together.
+        now = time.time()
+        with self.lock:
+            if (percent, operation) not in self.percentiles or now - self.percentiles[(percent, operation)][0] >= 1:
+                self._trim(now)
+                latencies = sorted(latency for (when, latency, ok, kind) in self.samples if ok and operation in (None, kind))
+                value = latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100.0))] if latencies else None
+                self.percentiles[(percent, operation)] = (now, value)
+            value = self.percentiles[(percent, operation)][1]
+            return default if value is None else value
+
+    def score(self):
+        # Lower is healthier.
+        return (not self.available(), self.errorRate(), self.percentile(50, default=0))
+
+    def statistics(self):
+        stats = {'available': self.available(), 'errorRate': self.errorRate(),
+                 'p50': self.percentile(50), 'p95': self.percentile(95), 'p99': self.percentile(99)}
+        with self.lock:
+            stats.update({'state': self.state, 'requests': len(self.samples), 'failures': self.failures})
+        return stats
+
+    def _allowed(self, now):
+        # Caller holds self.lock. A probe that has not been heard of for
+        # openTime seconds is taken to be lost, and another one may go.
+        if self.state == 'closed':
+            return True
+        if self.state == 'open':
+            return now - self.openedAt >= self.openTime
+        return self.probing is None or now - self.probing >= self.openTime
+
+    def _trim(self, now):
+        # Caller holds self.lock.
+        while self.samples and self.samples[0][0] < now - self.window:
+            (when, latency, ok, operation) = self.samples.popleft()
+            if not ok:
+                self.failures -= 1
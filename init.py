@@ -1,7 +1,10 @@
 import argparse
 import cherrypy
+import logging.handlers
 import os
 import socket
+import time
+import traceback
 
 class Root():
     favicon_ico = None
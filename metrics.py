@@ -0,0 +1,105 @@
+import bisect
+import contextlib
+import functools
+import re
+import threading
+import time
+
+class Metrics():
+    """
+    Counters, gauges and latency histograms, kept in memory and rendered in
+    the Prometheus text format. Recording a value costs a dictionary lookup
+    and a bisect under a lock, which is cheap enough to do for every S3
+    request and every SQL statement. Histograms have fixed buckets, so the
+    memory used only grows with the number of label combinations.
+    """
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.types = {}
+        self.values = {}
+
+    def describe(self, name, kind, text):
+        with self.lock:
+            self.types[name] = kind
+            self.help[name] = text
+
+    def increment(self, name, labels=None, value=1):
+        series = self._series(labels)
+        with self.lock:
+            values = self.values.setdefault(name, {})
+            values[series] = values.get(series, 0) + value
+
+    def set(self, name, labels=None, value=0):
+        series = self._series(labels)
+        with self.lock:
+            self.values.setdefault(name, {})[series] = value
+
+    def observe(self, name, labels, seconds):
+        series = self._series(labels)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            values = self.values.setdefault(name, {})
+            if series not in values:
+                values[series] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram = values[series]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, labels=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.time() - start)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.values):
+                kind = self.types.get(name, 'untyped')
+                if name in self.help:
+                    lines.append('# HELP %s %s' % (name, self.help[name]))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for (series, value) in sorted(self.values[name].items()):
+                    if kind != 'histogram':
+                        lines.append('%s%s %s' % (name, self._format(series), value))
+                        continue
+                    (counts, total) = value
+                    cumulative = 0
+                    for (bound, count) in zip(self.buckets + ('+Inf',), counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (name, self._format(series + (('le', str(bound)),)), cumulative))
+                    lines.append('%s_sum%s %f' % (name, self._format(series), total))
+                    lines.append('%s_count%s %d' % (name, self._format(series), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def _series(self, labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def _format(self, series):
+        if not series:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for (label, value) in series)
+
+@functools.lru_cache(maxsize=1024)
+def statement(query):
+    # Statements built for a number of rows or IN lists differ only in the
+    # number of placeholders; those are folded so they share one series.
+    return re.sub(r'\s+', ' ', re.sub(r'\(%s(, %s)*\)(, \(%s(, %s)*\))*', '(...)', query)).strip()
+
+registry = Metrics()
+registry.describe('s3_request_seconds', 'histogram', 'Latency of S3 requests by provider and operation.')
+registry.describe('s3_request_errors_total', 'counter', 'Failed S3 requests by provider and operation.')
+registry.describe('sql_statement_seconds', 'histogram', 'Latency of SQL statements.')
+registry.describe('sql_statement_errors_total', 'counter', 'Failed SQL statements.')
+registry.describe('db_pool_wait_seconds', 'histogram', 'Time spent waiting for a database connection.')
+registry.describe('sync_phase_seconds', 'histogram', 'Duration of sync phases.')
+registry.describe('sync_backlog', 'gauge', 'Work left for sync, as of the last count by any server.')
+registry.describe('sync_tasks_running', 'gauge', 'Sync tasks currently running on the sync pool.')
+registry.describe('s3_provider_available', 'gauge', 'Whether the circuit breaker lets requests through to the provider.')
+registry.describe('db_pool', 'untyped', 'Database connection pool statistics.')
+registry.describe('object_cache', 'untyped', 'Object cache statistics.')
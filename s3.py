@@ -1,59 +1,543 @@
 import base64
 import boto.s3
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import io
+import json
+import os
 import random
+import shutil
+import socket
 import string
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
 
 import db
+import health
+import metrics
+
+class MultipartUpload():
+    """
+    One provider's share of S3Sync._storeStream. Parts are uploaded on the
+    part pool and whichever thread sees the last outstanding part finish
+    completes the upload, or aborts it so that S3 drops the stored parts.
+    """
+    def __init__(self, s3, keyname, provider):
+        self.s3 = s3
+        self.provider = provider
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.reading = True
+        self.finished = False
+        self.error = None
+        self.result = concurrent.futures.Future()
+        try:
+            self.mp = s3._call(provider, s3.buckets[provider].initiate_multipart_upload, keyname)
+        except Exception as e:
+            self.mp = None
+            self.error = e
+
+    def upload(self, number, part, slots):
+        if self.error:
+            return
+        slots.acquire()
+        with self.lock:
+            self.outstanding += 1
+        future = self.s3.partPool.submit(self.s3._call, self.provider, self.mp.upload_part_from_file, io.BytesIO(part), number)
+        future.add_done_callback(lambda future: self._partDone(future, slots))
+
+    def fail(self, error):
+        with self.lock:
+            if not self.error:
+                self.error = error
+
+    def finish(self):
+        with self.lock:
+            self.reading = False
+        self._check()
+
+    def _partDone(self, future, slots):
+        slots.release()
+        with self.lock:
+            self.outstanding -= 1
+            if future.exception() and not self.error:
+                self.error = future.exception()
+        self._check()
+
+    def _check(self):
+        with self.lock:
+            if self.reading or self.outstanding or self.finished:
+                return
+            self.finished = True
+        try:
+            if self.error:
+                raise self.error
+            self.s3._call(self.provider, self.mp.complete_upload)
+            self.result.set_result(self.provider)
+        except Exception as e:
+            if self.mp:
+                try:
+                    self.mp.cancel_upload()
+                except Exception:
+                    pass
+            self.result.set_exception(e)
+
+class SpoolReader():
+    """
+    A read pass of its own over a seekable upload, from start onwards. Files
+    are read with pread through a duplicate of their descriptor, so passes do
+    not move each other's position and carry on after the request has closed
+    the original; in-memory uploads are copied.
+    """
+    def __init__(self, fp, start):
+        self.offset = start
+        self.fd = None
+        self.buffer = None
+        try:
+            self.fd = os.dup(fp.fileno())
+        except (AttributeError, io.UnsupportedOperation):
+            position = fp.tell()
+            fp.seek(start)
+            self.buffer = fp.read()
+            fp.seek(position)
+            self.offset = 0
+
+    def read(self, size):
+        if self.fd is None:
+            chunk = self.buffer[self.offset:self.offset + size]
+        else:
+            chunk = os.pread(self.fd, size, self.offset)
+        self.offset += len(chunk)
+        return chunk
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.buffer = None
 
 class S3Sync():
-    def __init__(self, pri, sec, log):
+    names = {'pri': 'Primary', 'sec': 'Secondary'}
+    # First characters of object keys and blob names, in S3 listing order.
+    shardAlphabet = ''.join(sorted(string.ascii_letters + string.digits))
+    # Turns random bytes into key characters. The bytes from 248 up are
+    # dropped so that every one of the 62 characters is equally likely.
+    keyTable = bytes.maketrans(bytes(range(248)), (string.ascii_letters + string.digits).encode('ascii') * 4)
+    keyDrop = bytes(range(248, 256))
+    backlogInterval = 60
+
+    def __init__(self, pri, sec, log, chunkSize=1048576, partSize=8388608, uploadConcurrency=4, uploadThreads=16, replication='async', syncThreads=16, syncBudget=50, syncBatch=1000, syncMode='full', reconcileInterval=86400, syncShards=1, syncLeaseTime=120, keyPoolSize=100, keyPoolMaxAge=300, listLimit=1000, dedup=False, compressTypes=[], compressLevel=6, presignExpiry=300, readThreads=16, batchThreads=8, hedgePercentile=95, hedgeDelay=0.5, cache=None, providerHealth=None):
         # boto.set_stream_logger('s3')
         self.buckets = {
           'pri': boto.s3.connect_to_region(pri['region'], aws_access_key_id=pri['access'], aws_secret_access_key=pri['secret']).get_bucket(pri['bucket']),
           'sec': boto.s3.connect_to_region(sec['region'], aws_access_key_id=sec['access'], aws_secret_access_key=sec['secret']).get_bucket(sec['bucket'])
         }
         self.log = log
+        self.chunkSize = chunkSize
+        self.cache = cache
+        self.listLimit = listLimit
+        self.dedup = dedup
+        self.compressTypes = [mimeType.lower() for mimeType in compressTypes]
+        self.compressLevel = compressLevel
+        self.presignExpiry = presignExpiry
+        self.partSize = partSize
+        self.uploadConcurrency = uploadConcurrency
+        if replication not in ['async', 'first', 'both']:
+            raise ValueError('Unknown replication policy: %s' % replication)
+        self.replication = replication
+        self.partPool = concurrent.futures.ThreadPoolExecutor(max_workers=uploadThreads)
+        self.syncPool = concurrent.futures.ThreadPoolExecutor(max_workers=syncThreads)
+        self.syncBudget = syncBudget
+        self.syncBatch = syncBatch
+        if syncMode not in ['full', 'incremental']:
+            raise ValueError('Unknown sync mode: %s' % syncMode)
+        self.syncMode = syncMode
+        self.reconcileInterval = reconcileInterval
+        if not 1 <= syncShards <= len(self.shardAlphabet):
+            raise ValueError('Number of sync shards must be between 1 and %d' % len(self.shardAlphabet))
+        self.syncShards = syncShards
+        self.syncLeaseTime = syncLeaseTime
+        self.syncOwner = '%s/%d/%s' % (socket.gethostname(), os.getpid(), ''.join(random.choice(string.hexdigits.lower()) for x in range(8)))
+        self.syncLock = threading.Lock()
+        self.keyPoolSize = keyPoolSize
+        self.keyPoolMaxAge = keyPoolMaxAge
+        # Uploads get 15 minutes from the moment their key is handed out, and
+        # a pooled key may have been reserved up to keyPoolMaxAge before that.
+        self.uploadTimeout = 900 + (keyPoolMaxAge if keyPoolSize else 0)
+        self.keyPool = collections.deque()
+        self.keyPoolLock = threading.Lock()
+        self.keysWanted = threading.Event()
+        self.keyFiller = None
+        self.keyCounters = {'reserved': 0, 'taken': 0, 'expired': 0, 'fallbacks': 0}
+        self.limits = {'pri': threading.BoundedSemaphore(pri.get('concurrency', 8)),
+                       'sec': threading.BoundedSemaphore(sec.get('concurrency', 8))}
+        self.running = set()
+        self.runningLock = threading.Lock()
+        self.readPool = concurrent.futures.ThreadPoolExecutor(max_workers=readThreads)
+        self.batchThreads = batchThreads
+        self.batchPool = concurrent.futures.ThreadPoolExecutor(max_workers=batchThreads)
+        self.hedgePercentile = hedgePercentile
+        self.hedgeDelay = hedgeDelay
+        self.health = providerHealth or {'pri': health.ProviderHealth(), 'sec': health.ProviderHealth()}
+        self.probes = threading.local()
+        # Columns added by later versions are only used once they exist, so
+        # that an existing database keeps working until it has been migrated.
+        self.columns = self._columns('objects')
+        if self.compressTypes and 'codec' not in self.columns:
+            raise ValueError('Compression needs objects.codec: ALTER TABLE `objects` ADD `codec` varchar(16) CHARACTER SET ascii DEFAULT NULL AFTER `mimeType`')
+        # Without objects.blob nothing can be deduplicated, and neither the
+        # column nor the blobs table is touched.
+        self.blobs = 'blob' in self.columns
+        if self.dedup and not self.blobs:
+            raise ValueError('Deduplication needs objects.blob and the blobs table from s3.sql: ALTER TABLE `objects` ADD `blob` int(11) DEFAULT NULL AFTER `sec`, ADD KEY `blob` (`blob`)')
+        self.plainFilter = ' AND `blob` IS NULL' if self.blobs else ''
+        # Sync keeps its leases and checkpoints in tables of its own, and the
+        # journal in incremental mode; those have to be created first.
+        missing = set(['syncState', 'syncLeases'] + (['journal'] if self.syncMode == 'incremental' else [])) - self._tables()
+        if missing:
+            raise ValueError('Sync needs the %s table%s from s3.sql' % (', '.join('`%s`' % table for table in sorted(missing)), '' if len(missing) == 1 else 's'))
+        if self.blobs:
+            self.selectObjects = 'SELECT `objects`.*, `blobs`.`hash`, `blobs`.`pri` AS `blobPri`, `blobs`.`sec` AS `blobSec` FROM `objects` LEFT JOIN `blobs` ON `blobs`.`id` = `objects`.`blob`'
+        else:
+            self.selectObjects = 'SELECT `objects`.* FROM `objects`'
 
     def get(self, key, user):
-        with db.DatabaseCursor() as cursor:
-            cursor.execute('SELECT * FROM `objects` WHERE `key` = %s AND `user` = %s AND `uploading` = %s', (key, user, False))
-            items = list(cursor.fetchall())
-        if len(items) != 1:
+        item = self._lookup(key, user)
+        if not item:
+            return None
+
+        s3name = self._s3name(item)
+        content = self.cache.get(s3name) if self.cache else None
+        if content is None:
+            content = self._read(item['id'], self._retrieveKey, s3name, 'retrieval', 'GET')
+            if content is None:
+                return None
+            if self.cache:
+                self.cache.put(s3name, content)
+        if item.get('codec') == 'gzip':
+            content = gzip.decompress(content)
+        return {'name': item['name'], 'content': base64.b64encode(content).decode('ascii'), 'mimeType': item['mimeType']}
+
+    def open(self, key, user):
+        item = self._lookup(key, user)
+        if not item:
+            return None
+        return self._open(item)
+
+    def _open(self, item):
+        # Objects never change, so the key itself makes a strong validator.
+        s3name = self._s3name(item)
+        info = {'s3name': s3name, 'name': item['name'], 'mimeType': item['mimeType'], 'codec': item.get('codec'), 'etag': '"%s"' % hashlib.sha1(item['key'].encode('utf-8')).hexdigest()}
+        content = self.cache.get(s3name) if self.cache else None
+        if content is not None:
+            info.update({'size': len(content), 'content': content})
+            return info
+
+        s3object = self._read(item['id'], self._key, s3name, 'lookup', 'OPEN')
+        if s3object is None:
             return None
+        info.update({'size': s3object.size, 'object': s3object})
+        return info
 
+    def presignDownload(self, key, user):
+        # A short-lived URL that lets the client fetch the object straight from
+        # the healthiest bucket holding a copy. Signing happens locally, so
+        # this costs one database lookup and no S3 request.
+        item = self._lookup(key, user)
+        if not item:
+            return None
+
+        copies = {'pri': item['blobPri'], 'sec': item['blobSec']} if item.get('blob') else item
+        providers = [provider for provider in self._providers() if copies[provider]]
+        if not providers:
+            return None
+        disposition = 'attachment; filename*=UTF-8\'\'%s' % urllib.parse.quote(item['name'] or key[:16])
+        responseHeaders = {'response-content-type': item['mimeType'] or 'application/octet-stream', 'response-content-disposition': disposition}
+        if item.get('codec'):
+            responseHeaders['response-content-encoding'] = item['codec']
+        s3object = self.buckets[providers[0]].new_key(self._s3name(item))
+        return {'url': s3object.generate_url(self.presignExpiry, method='GET', response_headers=responseHeaders), 'expires': self.presignExpiry}
+
+    def stream(self, info, start=None, end=None):
+        # Yields the object body opened by open() in chunkSize pieces so that
+        # neither the whole object nor its base64 encoding is ever held in
+        # memory. Complete reads of small enough objects fill the cache.
+        if start is None:
+            (start, end) = (0, info['size'] - 1)
+        if 'content' in info:
+            for offset in range(start, end + 1, self.chunkSize):
+                yield info['content'][offset:min(offset + self.chunkSize, end + 1)]
+            return
+
+        fill = self.cache is not None and start == 0 and end == info['size'] - 1 and info['size'] <= self.cache.maxObjectSize
+        chunks = []
+        s3object = info['object']
+        s3object.open_read(headers={'Range': 'bytes=%d-%d' % (start, end)} if end >= start else {})
         try:
-            content = self._retrieveKey(items[0]['key'], 'pri')
-        except Exception as e:
-            self.log.log(msg='Primary retrieval for %s failed: %s' % (items[0]['id'], str(e)), context='GET')
-            try:
-                content = self._retrieveKey(items[0]['key'], 'sec')
-            except Exception as e:
-                self.log.log(msg='Secondary retrieval for %s failed: %s' % (items[0]['id'], str(e)), context='GET')
-                raise
-        return {'name': items[0]['name'], 'content': base64.b64encode(content).decode('ascii'), 'mimeType': items[0]['mimeType']}
+            while True:
+                chunk = s3object.read(self.chunkSize)
+                if not chunk:
+                    break
+                if fill:
+                    chunks.append(chunk)
+                yield chunk
+        finally:
+            s3object.close(fast=True)
+        if fill:
+            self.cache.put(info['s3name'], b''.join(chunks))
+
+    def streamDecoded(self, info):
+        # Like stream(), but undoes the storage codec for clients that cannot
+        # take the stored form as it is. Output is produced chunkSize at a time.
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for chunk in self.stream(info):
+            data = decompressor.decompress(chunk, self.chunkSize)
+            while data:
+                yield data
+                data = decompressor.decompress(decompressor.unconsumed_tail, self.chunkSize)
+        data = decompressor.flush()
+        if data:
+            yield data
 
     def list(self, user):
         with db.DatabaseCursor() as cursor:
             cursor.execute('SELECT * FROM `objects` WHERE `user` = %s AND `deleteAfter` IS NULL AND `uploading` = %s', (user, False))
             return list(cursor.fetchall())
 
+    def listPage(self, user, limit=100, cursor=None):
+        # Keyset pagination over the `userObjects` index: the opaque cursor
+        # carries the id of the last object handed out, so every page costs
+        # the same however many objects the user or the table holds.
+        limit = max(1, min(int(limit), self.listLimit))
+        after = 0
+        if cursor:
+            try:
+                after = int(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii'))
+            except Exception:
+                raise ValueError('Invalid cursor')
+        with db.DatabaseCursor() as dbCursor:
+            dbCursor.execute('SELECT `id`, `key`, `name`, `mimeType`, `created` FROM `objects` WHERE `user` = %s AND `uploading` = %s AND `deleteAfter` IS NULL AND `id` > %s ORDER BY `id` LIMIT %s',
+                             (user, False, after, limit + 1))
+            items = list(dbCursor.fetchall())
+        nextCursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            nextCursor = base64.urlsafe_b64encode(str(items[-1]['id']).encode('ascii')).decode('ascii')
+        for item in items:
+            del item['id']
+        return {'items': items, 'cursor': nextCursor}
+
+    def presignUpload(self, name, mimeType):
+        # Reserves a key and hands out a URL for putting the content straight
+        # into the healthiest bucket. The row stays in uploading state until
+        # confirmUpload() finds the object, and is cleaned up by sync if that
+        # never happens. Presigned uploads are neither compressed nor
+        # deduplicated; the other bucket gets its copy from sync.
+        (id, key) = self._generateKey()
+        mimeType = mimeType or 'application/octet-stream'
+        with db.DatabaseCursor() as cursor:
+            cursor.execute('UPDATE `objects` SET `name` = %s, `mimeType` = %s WHERE `id` = %s', (name, mimeType, id))
+        s3object = self.buckets[self._providers()[0]].new_key(key)
+        headers = {'Content-Type': mimeType}
+        return {'key': key, 'method': 'PUT', 'headers': headers, 'expires': self.presignExpiry,
+                'url': s3object.generate_url(self.presignExpiry, method='PUT', headers=headers)}
+
+    def confirmUpload(self, key):
+        # Completes a presigned upload. Returns False while the object cannot
+        # be found in either bucket; keys that are not waiting for a presigned
+        # upload are left alone.
+        with db.DatabaseCursor() as cursor:
+            cursor.execute('SELECT `id`, `name`, `mimeType` FROM `objects` WHERE `key` = %s AND `uploading` = %s', (key, True))
+            item = cursor.fetchone()
+        if not item:
+            return True
+
+        stored = {}
+        for provider in self._providers():
+            try:
+                if self._existsKey(key, provider):
+                    stored[provider] = True
+                    break
+            except Exception as e:
+                self.log.log(msg='%s lookup for %s failed: %s' % (self.names[provider], item['id'], str(e)), context='CONFIRM')
+        if not stored:
+            return False
+        self._completeUpload(key, {'name': item['name'], 'mimeType': item['mimeType'], 'codec': None}, None, stored)
+        return True
+
     def receiveFile(self, name, content, mimeType):
+        return self.receiveStream(name, io.BytesIO(content), mimeType)
+
+    def receiveStream(self, name, fp, mimeType):
         (id, key) = self._generateKey()
+        meta = {'name': name, 'mimeType': mimeType, 'codec': None}
+        spool = None
+        if self._compressible(mimeType) and fp.seekable():
+            (spool, meta['codec']) = self._compress(fp)
+            if spool:
+                fp = spool
+
         try:
-            self._storeKey(key, content, 'pri')
-            with db.DatabaseCursor() as cursor:
-                cursor.execute('UPDATE `objects` SET `name` = %s, `mimeType` = %s, `uploading` = %s, `pri` = %s WHERE `key` = %s', (name, mimeType, False, True, key))
-        except Exception as e:
-            self.log.log(msg='Primary storage for %s failed: %s' % (id, str(e)), context='RECV')
+            blob = None
+            if self.dedup and fp.seekable():
+                blob = self._claimBlob(key, fp)
+                if blob['pri'] or blob['sec']:
+                    # Somebody uploaded the same content before; share their copy.
+                    self._completeUpload(key, meta, blob, {})
+                    return key
+
+            if self.replication != 'async':
+                received = self._receiveReplicated(id, key, meta, fp, blob)
+            else:
+                received = self._receiveAsync(id, key, meta, fp, blob)
+            if not received and blob:
+                self._releaseUpload(key)
+            return received
+        finally:
+            if spool:
+                spool.close()
+
+    def _receiveAsync(self, id, key, meta, fp, blob):
+        # The healthier bucket gets the upload; the other one is the fallback.
+        start = fp.tell()
+        for provider in self._providers():
             try:
-                self._storeKey(key, content, 'sec')
-                with db.DatabaseCursor() as cursor:
-                    cursor.execute('UPDATE `objects` SET `name` = %s, `mimeType` = %s, `uploading` = %s, `sec` = %s WHERE `key` = %s', (name, mimeType, False, True, key))
+                fp.seek(start)
+                self._storeStream(self._blobName(blob) if blob else key, fp, [provider])[provider].result()
+                self._completeUpload(key, meta, blob, {provider: True})
+                return key
             except Exception as e:
-                self.log.log(msg='Secondary storage for %s failed: %s' % (id, str(e)), context='RECV')
-                return None
+                self.log.log(msg='%s storage for %s failed: %s' % (self.names[provider], id, str(e)), context='RECV')
+        return None
+
+    def _receiveReplicated(self, id, key, meta, fp, blob):
+        # Writes both copies at once. With the 'first' policy the request is
+        # acknowledged as soon as one copy is stored and the other one sets its
+        # flag when it lands; with 'both' every copy has to succeed.
+        futures = self._storeStream(self._blobName(blob) if blob else key, fp, ['pri', 'sec'])
+        pending = set(futures.values())
+        while pending:
+            (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            if self.replication == 'first' and any(not future.exception() for future in done):
+                break
+
+        stored = {}
+        for (provider, future) in futures.items():
+            if future.done():
+                stored[provider] = not future.exception()
+                if future.exception():
+                    self.log.log(msg='%s storage for %s failed: %s' % (self.names[provider], id, str(future.exception())), context='RECV')
+        if not any(stored.values()) or (self.replication == 'both' and not all(stored.values())):
+            return None
+
+        self._completeUpload(key, meta, blob, stored)
+        for (provider, future) in futures.items():
+            if provider not in stored:
+                future.add_done_callback(lambda future, provider=provider: self._storedLate(id, key, blob, provider, future))
         return key
 
+    def _storedLate(self, id, key, blob, provider, future):
+        if future.exception():
+            self.log.log(msg='%s storage for %s failed: %s' % (self.names[provider], id, str(future.exception())), context='RECV')
+            return
+        with db.DatabaseCursor() as cursor:
+            if blob:
+                cursor.execute('UPDATE `blobs` SET `%s` = %%s WHERE `id` = %%s' % provider, (True, blob['id']))
+            else:
+                cursor.execute('UPDATE `objects` SET `%s` = %%s WHERE `key` = %%s' % provider, (True, key))
+            self._journal(cursor, 'replicated', [key])
+
+    def _completeUpload(self, key, meta, blob, stored):
+        # Records which copies exist, in one statement for plain objects. The
+        # copies of a deduplicated object belong to its blob.
+        fields = [('name', meta['name']), ('mimeType', meta['mimeType']), ('uploading', False)]
+        if 'codec' in self.columns:
+            fields.append(('codec', meta['codec']))
+        flags = list(stored.items())
+        with db.DatabaseCursor() as cursor:
+            if blob:
+                if stored:
+                    cursor.execute('UPDATE `blobs` SET %s WHERE `id` = %%s' % self._assignments(flags), [value for (column, value) in flags] + [blob['id']])
+            else:
+                fields += flags
+            cursor.execute('UPDATE `objects` SET %s WHERE `key` = %%s' % self._assignments(fields), [value for (column, value) in fields] + [key])
+            self._journal(cursor, 'completed', [key])
+
+    def _assignments(self, fields):
+        return ', '.join('`%s` = %%s' % column for (column, value) in fields)
+
+    def _columns(self, table):
+        with db.DatabaseCursor() as cursor:
+            cursor.execute('SELECT `COLUMN_NAME` FROM `information_schema`.`COLUMNS` WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = %s', (table,))
+            return set(row['COLUMN_NAME'] for row in cursor.fetchall())
+
+    def _tables(self):
+        with db.DatabaseCursor() as cursor:
+            cursor.execute('SELECT `TABLE_NAME` FROM `information_schema`.`TABLES` WHERE `TABLE_SCHEMA` = DATABASE()')
+            return set(row['TABLE_NAME'] for row in cursor.fetchall())
+
+    def _compressible(self, mimeType):
+        mimeType = (mimeType or '').split(';')[0].strip().lower()
+        for pattern in self.compressTypes:
+            if mimeType == pattern or (pattern.endswith('/*') and mimeType.startswith(pattern[:-1])):
+                return True
+        return False
+
+    def _compress(self, fp):
+        # Compresses the upload once into a spool file, deterministically so
+        # that deduplication still recognises identical content. Returns
+        # (None, None) when compression does not make the content smaller.
+        start = fp.tell()
+        spool = tempfile.TemporaryFile()
+        with gzip.GzipFile(filename='', mode='wb', fileobj=spool, compresslevel=self.compressLevel, mtime=0) as compressed:
+            shutil.copyfileobj(fp, compressed, self.chunkSize)
+        if spool.tell() >= fp.tell() - start:
+            spool.close()
+            fp.seek(start)
+            return (None, None)
+        spool.seek(0)
+        return (spool, 'gzip')
+
+    def _claimBlob(self, key, fp):
+        # Hashes the (spooled) upload and takes a reference on the blob with
+        # that content, creating it if it is new. The reference is recorded on
+        # the object in the same transaction, so that removing the object
+        # always gives it back.
+        start = fp.tell()
+        digest = hashlib.sha256()
+        while True:
+            chunk = fp.read(self.chunkSize)
+            if not chunk:
+                break
+            digest.update(chunk)
+        fp.seek(start)
+
+        with db.DatabaseCursor(autoCommit=False) as cursor:
+            cursor.execute('INSERT INTO `blobs` (`hash`, `refs`) VALUES (%s, %s) ON DUPLICATE KEY UPDATE `refs` = `refs` + 1, `id` = LAST_INSERT_ID(`id`)', (digest.hexdigest(), 1))
+            blobId = cursor.lastrowid()
+            cursor.execute('UPDATE `objects` SET `blob` = %s WHERE `key` = %s', (blobId, key))
+            cursor.execute('SELECT * FROM `blobs` WHERE `id` = %s', (blobId,))
+            return cursor.fetchone()
+
+    def _releaseUpload(self, key):
+        with db.DatabaseCursor(autoCommit=False) as cursor:
+            cursor.execute('SELECT `id` FROM `objects` WHERE `key` = %s FOR UPDATE', (key,))
+            ids = [obj['id'] for obj in cursor.fetchall()]
+            if ids:
+                self._releaseBlobs(cursor, ids)
+                cursor.execute('UPDATE `objects` SET `blob` = NULL WHERE `id` IN %s', (ids,))
+
+    def _releaseBlobs(self, cursor, ids):
+        # Gives back the blob references held by the objects in ids.
+        cursor.execute('UPDATE `blobs` JOIN (SELECT `blob`, COUNT(*) AS `count` FROM `objects` WHERE `id` IN %s AND `blob` IS NOT NULL GROUP BY `blob`) AS `released` '
+                       'ON `blobs`.`id` = `released`.`blob` SET `blobs`.`refs` = `blobs`.`refs` - `released`.`count`', (ids,))
+
     def storeFile(self, key, user):
         with db.DatabaseCursor() as cursor:
             cursor.execute('UPDATE `objects` SET `user` = %s WHERE `key` = %s', (user, key))
@@ -61,100 +545,842 @@ class S3Sync():
     def delete(self, user, key):
         with db.DatabaseCursor() as cursor:
             cursor.execute('UPDATE `objects` SET `deleteAfter` = DATE_ADD(NOW(), INTERVAL 10 MINUTE) WHERE `key` = %s AND `user` = %s', (key, user))
+            if cursor.rowcount():
+                self._journal(cursor, 'deleted', [key])
+        if self.cache:
+            self.cache.invalidate(key)
         return
 
+    def storeFiles(self, keys, user):
+        # Assigns many uploaded keys to user with one UPDATE. Presigned uploads
+        # that have not been confirmed yet are confirmed first. Returns the
+        # status of every key, in the order asked for.
+        with db.DatabaseCursor() as cursor:
+            cursor.execute('SELECT `key`, `uploading` FROM `objects` WHERE `key` IN %s', (keys,))
+            uploading = dict((obj['key'], obj['uploading']) for obj in cursor.fetchall())
+        status = {}
+        for key in keys:
+            if key not in uploading:
+                status[key] = 'notFound'
+            elif uploading[key] and not self.confirmUpload(key):
+                status[key] = 'pending'
+            else:
+                status[key] = 'stored'
+
+        stored = [key for key in uploading if status[key] == 'stored']
+        if stored:
+            with db.DatabaseCursor() as cursor:
+                cursor.execute('UPDATE `objects` SET `user` = %s WHERE `key` IN %s', (user, stored))
+        return [{'key': key, 'status': status[key]} for key in keys]
+
+    def deleteObjects(self, user, keys):
+        # Batch version of delete(): one UPDATE marks all of the user's keys.
+        with db.DatabaseCursor() as cursor:
+            cursor.execute('SELECT `key` FROM `objects` WHERE `key` IN %s AND `user` = %s AND `deleteAfter` IS NULL', (keys, user))
+            found = set(obj['key'] for obj in cursor.fetchall())
+            if found:
+                cursor.execute('UPDATE `objects` SET `deleteAfter` = DATE_ADD(NOW(), INTERVAL 10 MINUTE) WHERE `key` IN %s AND `user` = %s', (list(found), user))
+                self._journal(cursor, 'deleted', list(found))
+        if self.cache:
+            for key in found:
+                self.cache.invalidate(key)
+        return [{'key': key, 'status': 'deleted' if key in found else 'notFound'} for key in keys]
+
+    def archive(self, keys, user):
+        # Streams the objects as a tar archive, each one as <key>/<name>, and
+        # ends it with status.json holding the status of every key. Objects
+        # are looked up in one query and fetched on the batch pool, up to
+        # batchThreads ahead of the one being sent; those larger than
+        # partSize are streamed from S3 when their turn comes instead of
+        # being held in memory. Compressed objects are archived as stored,
+        # with .gz added to their name.
+        # The lookup happens here rather than in the generator, so that a
+        # database failure still ends in an error status instead of a broken
+        # archive.
+        with db.DatabaseCursor() as cursor:
+            cursor.execute(self.selectObjects + ' WHERE `objects`.`key` IN %s AND `objects`.`user` = %s AND `objects`.`uploading` = %s', (keys, user, False))
+            items = dict((item['key'], item) for item in cursor.fetchall())
+        return self._archive(list(collections.OrderedDict.fromkeys(keys)), items)
+
+    def _archive(self, keys, items):
+        status = dict((key, {'status': 'notFound'}) for key in keys if key not in items)
+        pending = collections.deque()
+        queue = collections.deque(key for key in keys if key in items)
+        while queue or pending:
+            while queue and len(pending) < self.batchThreads:
+                key = queue.popleft()
+                pending.append((key, self.batchPool.submit(self._fetch, items[key])))
+            (key, future) = pending.popleft()
+            try:
+                info = future.result()
+            except Exception as e:
+                self.log.log(msg='Batch retrieval for %s failed: %s' % (items[key]['id'], str(e)), context='BATCH')
+                info = None
+            if not info:
+                status[key] = {'status': 'error'}
+                continue
+
+            name = (info['name'] or key[:16]).replace('/', '_') + ('.gz' if info.get('codec') else '')
+            yield self._tarHeader('%s/%s' % (key, name), info['size'], items[key]['created'])
+            # The header has gone out with the size, so an object that fails
+            # halfway is padded to that size to keep the archive readable.
+            sent = 0
+            try:
+                for chunk in (self.stream(info) if 'object' in info else [info['content']]):
+                    sent += len(chunk)
+                    yield chunk
+                status[key] = {'status': 'ok', 'size': info['size']}
+            except Exception as e:
+                self.log.log(msg='Batch retrieval for %s failed after %d bytes: %s' % (items[key]['id'], sent, str(e)), context='BATCH')
+                status[key] = {'status': 'error'}
+                for offset in range(sent, info['size'], self.chunkSize):
+                    yield b'\0' * min(self.chunkSize, info['size'] - offset)
+            yield b'\0' * (-info['size'] % tarfile.BLOCKSIZE)
+
+        manifest = json.dumps({'items': [dict({'key': key}, **status[key]) for key in keys]}).encode('utf-8')
+        yield self._tarHeader('status.json', len(manifest), None)
+        yield manifest + b'\0' * (-len(manifest) % tarfile.BLOCKSIZE)
+        yield b'\0' * (2 * tarfile.BLOCKSIZE)
+
+    def _fetch(self, item):
+        info = self._open(item)
+        if info and 'object' in info and info['size'] <= self.partSize:
+            info['content'] = b''.join(self.stream(info))
+            del info['object']
+        return info
+
+    def _tarHeader(self, name, size, created):
+        header = tarfile.TarInfo(name)
+        header.size = size
+        header.mode = 0o644
+        header.mtime = time.mktime(created.timetuple()) if created else time.time()
+        return header.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8')
+
+    def statistics(self):
+        return {'cache': self.cache.statistics() if self.cache else None,
+                'database': db.statistics(),
+                'health': dict((provider, self.health[provider].statistics()) for provider in ['pri', 'sec']),
+                'keyPool': self._keyPoolStatistics()}
+
+    def _keyPoolStatistics(self):
+        with self.keyPoolLock:
+            stats = dict(self.keyCounters)
+            stats.update({'size': self.keyPoolSize, 'available': len(self.keyPool)})
+        return stats
+
     def sync(self):
+        # A pass is split into phases whose S3 operations run on the sync pool.
+        # Every phase stops handing out work once the pass budget is used up;
+        # whatever is left over is picked up again by the next pass.
+        if not self.syncLock.acquire(blocking=False):
+            self.log.log(msg='Previous sync pass still running, skipping', context='SYNC')
+            return
+        # Several servers can sync the same buckets: the journal and each shard
+        # of the key space are leased through the database, so every piece of
+        # work is done by one server at a time and more servers get through
+        # more shards per pass.
+        try:
+            deadline = time.time() + self.syncBudget
+            with metrics.registry.timer('sync_phase_seconds', {'phase': 'uploads'}):
+                self._syncUploads()
+            leases = ['shard.%d' % shard for shard in range(self.syncShards)]
+            with db.DatabaseCursor() as cursor:
+                cursor.execute('INSERT IGNORE INTO `syncLeases` (`name`) VALUES %s' % ', '.join(['(%s)'] * (len(leases) + 2)), leases + ['journal', 'backlog'])
+            if self.syncMode == 'incremental' and self._claimLease(['journal']):
+                try:
+                    with metrics.registry.timer('sync_phase_seconds', {'phase': 'journal'}):
+                        self._syncJournal(deadline)
+                finally:
+                    self._releaseLease('journal')
+            while leases and time.time() < deadline:
+                lease = self._claimLease(leases)
+                if not lease:
+                    break
+                leases.remove(lease)
+                try:
+                    self._syncShard(int(lease.split('.')[1]), deadline)
+                finally:
+                    self._releaseLease(lease)
+            self._syncBacklog()
+        finally:
+            self.syncLock.release()
+
+    def _syncShard(self, shard, deadline):
+        # Expiry and replicas go first: listing a large bucket for orphans can
+        # take several passes, and must not use up the time they need.
+        with metrics.registry.timer('sync_phase_seconds', {'phase': 'expired'}):
+            self._syncExpired(deadline, shard)
+        self._renewLease('shard.%d' % shard)
+        if self.syncMode == 'full' or self._reconcileDue(shard):
+            # Full reconciliation: every pass in full mode, otherwise only
+            # every reconcileInterval seconds as a backstop for the journal.
+            with metrics.registry.timer('sync_phase_seconds', {'phase': 'replicas'}):
+                self._syncReplicas(deadline, shard=shard)
+            self._renewLease('shard.%d' % shard)
+            with metrics.registry.timer('sync_phase_seconds', {'phase': 'orphans'}):
+                reconciled = self._syncOrphans(deadline, shard)
+            if reconciled and self.syncMode == 'incremental':
+                with db.DatabaseCursor() as cursor:
+                    self._setState(cursor, 'shard.%d.reconcile.next' % shard, time.time() + self.reconcileInterval)
+
+    def _syncBacklog(self):
+        # Counting the backlog scans the objects table, so it is done at most
+        # every backlogInterval seconds by whichever server holds the lease,
+        # and kept in syncState for the other servers to publish as well.
+        with db.DatabaseCursor() as cursor:
+            backlog = self._getState(cursor, 'backlog')
+        backlog = json.loads(backlog) if backlog else None
+        if (backlog is None or time.time() >= backlog['next']) and self._claimLease(['backlog']):
+            try:
+                with db.DatabaseCursor() as cursor:
+                    backlog = self._getState(cursor, 'backlog')
+                backlog = json.loads(backlog) if backlog else None
+                if backlog is None or time.time() >= backlog['next']:
+                    backlog = {'next': time.time() + self.backlogInterval, 'counts': self._countBacklog()}
+                    with db.DatabaseCursor() as cursor:
+                        self._setState(cursor, 'backlog', json.dumps(backlog))
+            finally:
+                self._releaseLease('backlog')
+        for (kind, value) in (backlog['counts'] if backlog else []):
+            metrics.registry.set('sync_backlog', {'kind': kind}, value)
+        with self.runningLock:
+            metrics.registry.set('sync_tasks_running', None, len(self.running))
+
+    def _countBacklog(self):
+        with db.DatabaseCursor() as cursor:
+            cursor.execute('SELECT SUM(`uploading` = %%s) AS `uploading`, SUM(`deleteAfter` < NOW()) AS `expired`, '
+                           'SUM(`uploading` = %%s AND `deleteAfter` IS NULL%s AND (`pri` = %%s OR `sec` = %%s)) AS `unreplicated` FROM `objects`' % self.plainFilter, (True, False, False, False))
+            backlog = cursor.fetchone()
+            counts = [('uploading', backlog['uploading']), ('expired', backlog['expired']), ('unreplicated', backlog['unreplicated'])]
+            if self.blobs:
+                cursor.execute('SELECT SUM(`refs` > %s AND (`pri` = %s OR `sec` = %s)) AS `unreplicated`, SUM(`refs` <= %s) AS `expired` FROM `blobs`', (0, False, False, 0))
+                blobs = cursor.fetchone()
+                counts += [('unreplicatedBlobs', blobs['unreplicated']), ('expiredBlobs', blobs['expired'])]
+            if self.syncMode == 'incremental':
+                cursor.execute('SELECT COUNT(*) AS `journal` FROM `journal`')
+                counts.append(('journal', cursor.fetchone()['journal']))
+        return [(kind, int(value or 0)) for (kind, value) in counts]
+
+    def _claimLease(self, names):
+        # Takes the free lease out of names whose work was done longest ago.
+        # A lease whose server stopped renewing it is free again once it has
+        # expired. The claim is a conditional update, so of the servers that
+        # go for the same lease at the same moment only one changes the row;
+        # the others move on to the next candidate.
         with db.DatabaseCursor() as cursor:
+            cursor.execute('SELECT `name` FROM `syncLeases` WHERE `name` IN %s AND (`expires` IS NULL OR `expires` < NOW()) ORDER BY `finished`', (names,))
+            for lease in list(cursor.fetchall()):
+                if cursor.execute('UPDATE `syncLeases` SET `owner` = %s, `expires` = DATE_ADD(NOW(), INTERVAL %s SECOND) WHERE `name` = %s AND (`expires` IS NULL OR `expires` < NOW())', (self.syncOwner, self.syncLeaseTime, lease['name'])):
+                    return lease['name']
+        return None
+
+    def _renewLease(self, name):
+        with db.DatabaseCursor() as cursor:
+            cursor.execute('UPDATE `syncLeases` SET `expires` = DATE_ADD(NOW(), INTERVAL %s SECOND) WHERE `name` = %s AND `owner` = %s', (self.syncLeaseTime, name, self.syncOwner))
+
+    def _releaseLease(self, name):
+        with db.DatabaseCursor() as cursor:
+            cursor.execute('UPDATE `syncLeases` SET `owner` = NULL, `expires` = NULL, `finished` = NOW() WHERE `name` = %s AND `owner` = %s', (name, self.syncOwner))
+
+    def _shardRange(self, shard):
+        # Shard n covers the names starting with its slice of shardAlphabet.
+        # Returns (first, end) with end excluded, None meaning unbounded.
+        first = shard * len(self.shardAlphabet) // self.syncShards
+        end = (shard + 1) * len(self.shardAlphabet) // self.syncShards
+        return (self.shardAlphabet[first] if shard else None, self.shardAlphabet[end] if end < len(self.shardAlphabet) else None)
+
+    def _shardFilter(self, column, shard):
+        (first, end) = self._shardRange(shard)
+        conditions = []
+        if first:
+            conditions.append(('%s >= %%s' % column, first))
+        if end:
+            conditions.append(('%s < %%s' % column, end))
+        return (''.join(' AND ' + condition for (condition, value) in conditions), [value for (condition, value) in conditions])
+
+    def _syncUploads(self):
+        with db.DatabaseCursor(autoCommit=False) as cursor:
             # Remove objects where the upload is taking longer than expected.
-            cursor.execute('DELETE FROM `objects` WHERE `uploading` = %s AND NOW() > DATE_ADD(`created`, INTERVAL 15 MINUTE)', (True,))
+            # Rows holding a blob reference are deleted by id together with
+            # giving it back, so that no row that turns stale in between
+            # loses its reference.
+            if self.blobs:
+                cursor.execute('SELECT `id` FROM `objects` WHERE `uploading` = %s AND NOW() > DATE_ADD(`created`, INTERVAL %s SECOND) AND `blob` IS NOT NULL FOR UPDATE', (True, self.uploadTimeout))
+                ids = [obj['id'] for obj in cursor.fetchall()]
+                if ids:
+                    self._releaseBlobs(cursor, ids)
+                    cursor.execute('DELETE FROM `objects` WHERE `id` IN %s', (ids,))
+            cursor.execute('DELETE FROM `objects` WHERE `uploading` = %%s AND NOW() > DATE_ADD(`created`, INTERVAL %%s SECOND)%s' % self.plainFilter, (True, self.uploadTimeout))
 
-            for store in ['pri', 'sec']:
-                for s3Keys in self._listKeysBatch(store, batch=4096):
+    def _syncJournal(self, deadline):
+        # Incremental sync: only look at objects that changed since the last
+        # pass. Uploads that were started but never completed may have left a
+        # partial object behind; completed uploads need their second copy.
+        with db.DatabaseCursor() as cursor:
+            orphanMark = int(self._getState(cursor, 'journal.orphans') or 0)
+            # Started events are checked 5 minutes after their upload may
+            # have been cleaned up as stale.
+            cursor.execute('SELECT `id`, `key` FROM `journal` WHERE `event` = %s AND `id` > %s AND `created` < DATE_SUB(NOW(), INTERVAL %s SECOND) ORDER BY `id` LIMIT %s', ('started', orphanMark, self.uploadTimeout + 300, self.syncBatch))
+            started = list(cursor.fetchall())
+            orphanS3Keys = set()
+            if started:
+                cursor.execute('SELECT `key` FROM `objects` WHERE `key` IN %s', ([event['key'] for event in started],))
+                orphanS3Keys = set(event['key'] for event in started) - set(obj['key'] for obj in cursor.fetchall())
+
+        deleted = self._deleteMany(orphanS3Keys, ['pri', 'sec'], deadline)
+
+        with db.DatabaseCursor() as cursor:
+            if started:
+                # Deletes that failed or did not fit in this pass go to the back of the journal.
+                self._journal(cursor, 'started', sorted(orphanS3Keys - (deleted['pri'] & deleted['sec'])))
+                orphanMark = started[-1]['id']
+                self._setState(cursor, 'journal.orphans', orphanMark)
+            replicaMark = int(self._getState(cursor, 'journal.replicas') or 0)
+            # Ids are handed out when a row is inserted but become visible when
+            # it commits, so a row can show up behind one already read. The
+            # mark only moves past rows old enough for every transaction that
+            # could still insert below them to have ended.
+            cursor.execute('SELECT `id`, `key` FROM `journal` WHERE `event` = %s AND `id` > %s AND `created` < DATE_SUB(NOW(), INTERVAL 1 MINUTE) ORDER BY `id` LIMIT %s', ('completed', replicaMark, self.syncBatch))
+            completed = list(cursor.fetchall())
+
+        if completed:
+            failed = self._syncReplicas(deadline, keys=[event['key'] for event in completed])
+            with db.DatabaseCursor() as cursor:
+                # Copies that failed or did not fit in this pass go to the back of the journal.
+                self._journal(cursor, 'completed', failed)
+                replicaMark = completed[-1]['id']
+                self._setState(cursor, 'journal.replicas', replicaMark)
+
+        with db.DatabaseCursor() as cursor:
+            cursor.execute('DELETE FROM `journal` WHERE `id` <= %s AND `created` < DATE_SUB(NOW(), INTERVAL 1 DAY)', (min(orphanMark, replicaMark),))
+
+    def _reconcileDue(self, shard):
+        with db.DatabaseCursor() as cursor:
+            due = self._getState(cursor, 'shard.%d.reconcile.next' % shard)
+            running = self._getState(cursor, 'shard.%d.orphans.store' % shard)
+        return running is not None or due is None or time.time() >= float(due)
+
+    def _syncOrphans(self, deadline, shard):
+        # Lists the shard's part of both buckets for objects that are unknown
+        # to the database. The listing position is checkpointed after every
+        # batch so that a bucket too large for one pass is continued where the
+        # previous pass stopped. Returns True once both buckets have been
+        # listed to the end of the shard.
+        (first, end) = self._shardRange(shard)
+        with db.DatabaseCursor() as cursor:
+            store = self._getState(cursor, 'shard.%d.orphans.store' % shard) or 'pri'
+            marker = self._getState(cursor, 'shard.%d.orphans.marker' % shard) or first or ''
+
+        while True:
+            for s3Keys in self._listKeysBatch(store, batch=4096, marker=marker, end=end):
+                if time.time() > deadline:
+                    return False
+                if not s3Keys:
+                    continue
+                with db.DatabaseCursor() as cursor:
                     cursor.execute('SELECT `key` FROM `objects` WHERE `key` IN %s', (s3Keys,))
                     dbKeys = list(map(lambda key: key['key'], list(cursor.fetchall())))
+                    blobIds = [blobId for blobId in map(self._blobId, s3Keys) if blobId is not None] if self.blobs else []
+                    if blobIds:
+                        cursor.execute('SELECT `id`, `hash` FROM `blobs` WHERE `id` IN %s', (blobIds,))
+                        dbKeys += [self._blobName(blob) for blob in cursor.fetchall()]
 
-                    # Here we get the list of keys that exist in S3 but do not exist in the database.
-                    orphanS3Keys = set(s3Keys) - set(dbKeys)
-                    for orphanS3Key in list(orphanS3Keys):
-                        self.log.log(msg='Removing orphan S3 object: %s from %s' % (orphanS3Key, store), context='SYNC')
-                        self._deleteKey(orphanS3Key, store)
+                # Here we get the list of keys that exist in S3 but do not exist in the database.
+                orphanS3Keys = set(s3Keys) - set(dbKeys)
+                for orphanS3Key in list(orphanS3Keys):
+                    self.log.log(msg='Removing orphan S3 object: %s from %s' % (orphanS3Key, store), context='SYNC')
+                self._deleteMany(orphanS3Keys, [store], deadline)
 
-            # cursor.execute('UPDATE `objects` SET `%s` = %%s WHERE `key` = %%s' % store, (False, orphanS3Key))
+                marker = s3Keys[-1]
+                with db.DatabaseCursor() as cursor:
+                    self._setState(cursor, 'shard.%d.orphans.store' % shard, store)
+                    self._setState(cursor, 'shard.%d.orphans.marker' % shard, marker)
+                self._renewLease('shard.%d' % shard)
+            if store == 'sec':
+                break
+            (store, marker) = ('sec', first or '')
+            with db.DatabaseCursor() as cursor:
+                self._setState(cursor, 'shard.%d.orphans.store' % shard, store)
+                self._setState(cursor, 'shard.%d.orphans.marker' % shard, marker)
 
-            # Remove objects that need to be expired
-            cursor.execute('SELECT * FROM `objects` WHERE `deleteAfter` < NOW()')
-            for obj in list(cursor.fetchall()):
-                try:
-                    if self._existsKey(obj['key'], 'pri'):
-                        self._deleteKey(obj['key'], 'pri')
-                    cursor.execute('UPDATE `objects` SET `pri` = %s WHERE `id` = %s', (False, obj['id']))
-                except Exception as e:
-                    self.log.log(msg='Primary delete for %s failed: %s' % (obj['id'], str(e)), context='SYNC')
-                try:
-                    if self._existsKey(obj['key'], 'sec'):
-                        self._deleteKey(obj['key'], 'sec')
-                    cursor.execute('UPDATE `objects` SET `sec` = %s WHERE `id` = %s', (False, obj['id']))
-                except Exception as e:
-                    self.log.log(msg='Secondary delete for %s failed: %s' % (obj['id'], str(e)), context='SYNC')
-            cursor.execute('DELETE FROM `objects` WHERE `pri` = %s AND `sec` = %s AND `deleteAfter` < NOW()', (False, False))
-
-            # Sync remaining objects between pri<->sec storage
-            cursor.execute('SELECT * FROM `objects` WHERE `uploading` = %s AND deleteAfter IS NULL AND (`pri` = %s OR `sec` = %s)', (False, False, False))
-            for obj in list(cursor.fetchall()):
-                if obj['pri'] and not obj['sec']:
-                    try:
-                        content = self._retrieveKey(obj['key'], 'pri')
-                        self._storeKey(obj['key'], content, 'sec')
-                        cursor.execute('UPDATE `objects` SET `sec` = %s WHERE `id` = %s', (True, obj['id']))
-                    except Exception as e:
-                        self.log.log(msg='Copy to secondary for %s failed: %s' % (obj['id'], str(e)), context='SYNC')
-                if obj['sec'] and not obj['pri']:
-                    try:
-                        content = self._retrieveKey(obj['key'], 'sec')
-                        self._storeKey(obj['key'], content, 'pri')
-                        cursor.execute('UPDATE `objects` SET `pri` = %s WHERE `id` = %s', (True, obj['id']))
-                    except Exception as e:
-                        self.log.log(msg='Copy to primary for %s failed: %s' % (obj['id'], str(e)), context='SYNC')
+        with db.DatabaseCursor() as cursor:
+            cursor.execute('DELETE FROM `syncState` WHERE `name` IN %s', (['shard.%d.orphans.store' % shard, 'shard.%d.orphans.marker' % shard],))
+        return True
+
+    def _syncExpired(self, deadline, shard):
+        (keyFilter, keyRange) = self._shardFilter('`key`', shard)
+        (hashFilter, hashRange) = self._shardFilter('`hash`', shard)
+
+        # Deduplicated objects only give back their blob reference.
+        if self.blobs:
+            with db.DatabaseCursor(autoCommit=False) as cursor:
+                cursor.execute('SELECT `id` FROM `objects` WHERE `deleteAfter` < NOW() AND `blob` IS NOT NULL%s FOR UPDATE' % keyFilter, keyRange)
+                ids = [obj['id'] for obj in cursor.fetchall()]
+                if ids:
+                    self._releaseBlobs(cursor, ids)
+                    cursor.execute('DELETE FROM `objects` WHERE `id` IN %s', (ids,))
+
+        # Remove objects that need to be expired
+        with db.DatabaseCursor() as cursor:
+            cursor.execute('SELECT * FROM `objects` WHERE `deleteAfter` < NOW()%s%s' % (self.plainFilter, keyFilter), keyRange)
+            objs = dict((obj['key'], obj) for obj in cursor.fetchall())
+
+        # Deleting a key that is already gone succeeds, so there is no need to
+        # look the objects up before deleting them.
+        deleted = self._deleteMany(objs.keys(), ['pri', 'sec'], deadline)
+        if self.cache:
+            for key in objs:
+                self.cache.invalidate(key)
+
+        with db.DatabaseCursor() as cursor:
+            for store in ['pri', 'sec']:
+                for ids in self._batches([objs[key]['id'] for key in deleted[store]], self.syncBatch):
+                    cursor.execute('UPDATE `objects` SET `%s` = %%s WHERE `id` IN %%s' % store, (False, ids))
+            cursor.execute('DELETE FROM `objects` WHERE `pri` = %%s AND `sec` = %%s AND `deleteAfter` < NOW()%s%s' % (self.plainFilter, keyFilter), [False, False] + keyRange)
+
+        # Blobs go once their last reference is gone. The row is removed before
+        # the S3 objects: a new upload of the same content then creates a new
+        # blob under a new name instead of reusing the one being deleted.
+        if not self.blobs:
+            return
+        with db.DatabaseCursor(autoCommit=False) as cursor:
+            cursor.execute('SELECT `id`, `hash` FROM `blobs` WHERE `refs` <= %%s%s LIMIT %%s FOR UPDATE' % hashFilter, [0] + hashRange + [self.syncBatch])
+            blobs = list(cursor.fetchall())
+            if blobs:
+                cursor.execute('DELETE FROM `blobs` WHERE `id` IN %s', ([blob['id'] for blob in blobs],))
+        names = [self._blobName(blob) for blob in blobs]
+        self._deleteMany(names, ['pri', 'sec'], deadline)
+        if self.cache:
+            for name in names:
+                self.cache.invalidate(name)
+
+    def _syncReplicas(self, deadline, keys=None, shard=None):
+        # Sync remaining objects between pri<->sec storage, either those of a
+        # shard or only those out of keys. Returns the keys that are still
+        # missing a copy.
+        # Deduplicated objects are replicated through their blob, which is
+        # copied once however many objects refer to it.
+        with db.DatabaseCursor() as cursor:
+            if keys is None:
+                (keyFilter, keyRange) = self._shardFilter('`key`', shard)
+                (hashFilter, hashRange) = self._shardFilter('`hash`', shard)
+                cursor.execute('SELECT * FROM `objects` WHERE `uploading` = %%s AND deleteAfter IS NULL%s AND (`pri` = %%s OR `sec` = %%s)%s' % (self.plainFilter, keyFilter), [False, False, False] + keyRange)
+                objs = [dict(obj, table='objects', s3name=obj['key']) for obj in cursor.fetchall()]
+                if self.blobs:
+                    cursor.execute('SELECT * FROM `blobs` WHERE `refs` > %%s AND (`pri` = %%s OR `sec` = %%s)%s' % hashFilter, [0, False, False] + hashRange)
+                    objs += [dict(blob, table='blobs', s3name=self._blobName(blob), key=None) for blob in cursor.fetchall()]
+            elif keys:
+                cursor.execute('SELECT * FROM `objects` WHERE `key` IN %%s AND `uploading` = %%s AND deleteAfter IS NULL%s AND (`pri` = %%s OR `sec` = %%s)' % self.plainFilter, (keys, False, False, False))
+                objs = [dict(obj, table='objects', s3name=obj['key']) for obj in cursor.fetchall()]
+                if self.blobs:
+                    cursor.execute('SELECT `blobs`.*, `objects`.`key` FROM `blobs` JOIN `objects` ON `objects`.`blob` = `blobs`.`id` WHERE `objects`.`key` IN %s AND (`blobs`.`pri` = %s OR `blobs`.`sec` = %s)', (keys, False, False))
+                    objs += [dict(blob, table='blobs', s3name=self._blobName(blob)) for blob in cursor.fetchall()]
+            else:
+                return []
+        objs = dict((obj['s3name'], obj) for obj in objs)
+
+        tasks = []
+        for obj in objs.values():
+            if obj['pri'] and not obj['sec']:
+                tasks.append(('sec', obj['s3name'], self._copyKey, (obj['s3name'], 'pri', 'sec')))
+            if obj['sec'] and not obj['pri']:
+                tasks.append(('pri', obj['s3name'], self._copyKey, (obj['s3name'], 'sec', 'pri')))
+
+        copied = {'objects': {'pri': [], 'sec': []}, 'blobs': {'pri': [], 'sec': []}}
+        replicated = set()
+        for (store, s3name, error, result) in self._runPhase(tasks, deadline):
+            obj = objs[s3name]
+            if error:
+                self.log.log(msg='Copy to %s for %s failed: %s' % (self.names[store].lower(), obj['id'], str(error)), context='SYNC')
+            else:
+                copied[obj['table']][store].append(obj['id'])
+                replicated.add(s3name)
+
+        with db.DatabaseCursor() as cursor:
+            for table in ['objects', 'blobs']:
+                for store in ['pri', 'sec']:
+                    for ids in self._batches(copied[table][store], self.syncBatch):
+                        cursor.execute('UPDATE `%s` SET `%s` = %%s WHERE `id` IN %%s' % (table, store), (True, ids))
+            self._journal(cursor, 'replicated', [objs[s3name]['key'] for s3name in replicated if objs[s3name]['key']])
+        return [obj['key'] for (s3name, obj) in objs.items() if s3name not in replicated and obj['key']]
+
+    def _runPhase(self, tasks, deadline):
+        # Runs (provider, key, function, args) tasks on the sync pool with at
+        # most limits[provider] of them in flight per provider, and returns
+        # (provider, key, error, result) for those that finished before the
+        # deadline.
+        # Each provider has its own queue and tasks are started from whichever
+        # queue has a free slot, so a slow provider only holds up its own
+        # tasks and not those of the other one.
+        # Tasks that overrun keep their key in self.running so that the next
+        # pass does not start the same operation a second time.
+        queues = collections.OrderedDict()
+        for (provider, key, function, args) in tasks:
+            queues.setdefault(provider, collections.deque()).append((key, function, args))
+        futures = {}
+        freed = threading.Event()
+        while queues and time.time() < deadline:
+            freed.clear()
+            for provider in list(queues):
+                queue = queues[provider]
+                while queue and self.limits[provider].acquire(blocking=False):
+                    (key, function, args) = queue.popleft()
+                    with self.runningLock:
+                        if (provider, key) in self.running:
+                            self.limits[provider].release()
+                            continue
+                        self.running.add((provider, key))
+                    future = self.syncPool.submit(function, *args)
+                    future.add_done_callback(lambda future, provider=provider, key=key: self._taskDone(provider, key, freed))
+                    futures[future] = (provider, key)
+                if not queue:
+                    del queues[provider]
+            if queues:
+                # Slots may also be freed by tasks of an earlier pass that
+                # overran, which do not set the event; look again regularly.
+                freed.wait(timeout=max(0, min(1, deadline - time.time())))
+        if queues:
+            self.log.log(msg='Sync budget exhausted, %d tasks deferred' % sum(len(queue) for queue in queues.values()), context='SYNC')
+
+        results = []
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout=max(0, deadline - time.time())):
+                error = future.exception()
+                results.append(futures[future] + (error, None if error else future.result()))
+        except concurrent.futures.TimeoutError:
+            for future in futures:
+                future.cancel()
+            self.log.log(msg='Sync budget exhausted, %d tasks still running' % (len(futures) - len(results)), context='SYNC')
+        return results
+
+    def _deleteMany(self, keys, providers, deadline):
+        # Bulk deletes keys from each of the providers, up to 1000 keys per
+        # request, and returns the keys that are gone from each provider.
+        tasks = [(provider, tuple(chunk), self._deleteKeys, (chunk, provider)) for provider in providers for chunk in self._batches(sorted(keys), 1000)]
+        deleted = dict((provider, set()) for provider in providers)
+        for (provider, chunk, error, result) in self._runPhase(tasks, deadline):
+            if error:
+                self.log.log(msg='Bulk delete of %d objects from %s failed: %s' % (len(chunk), provider, str(error)), context='SYNC')
+                continue
+            (gone, errors) = result
+            deleted[provider].update(gone)
+            for (key, message) in errors:
+                self.log.log(msg='Delete for %s from %s failed: %s' % (key, provider, message), context='SYNC')
+        return deleted
+
+    def _taskDone(self, provider, key, freed):
+        self.limits[provider].release()
+        with self.runningLock:
+            self.running.discard((provider, key))
+        freed.set()
+
+    def _journal(self, cursor, event, keys):
+        if self.syncMode != 'incremental' or not keys:
+            return
+        cursor.execute('INSERT INTO `journal` (`key`, `event`) VALUES %s' % ', '.join(['(%s, %s)'] * len(keys)), [value for key in keys for value in (key, event)])
+
+    def _getState(self, cursor, name):
+        cursor.execute('SELECT `value` FROM `syncState` WHERE `name` = %s', (name,))
+        rows = list(cursor.fetchall())
+        return rows[0]['value'] if rows else None
+
+    def _setState(self, cursor, name, value):
+        cursor.execute('INSERT INTO `syncState` (`name`, `value`) VALUES (%s, %s) ON DUPLICATE KEY UPDATE `value` = VALUES(`value`)', (name, str(value)))
+
+    def _batches(self, items, size):
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
 
     def _generateKey(self):
+        # Hands out a row reserved ahead of time by the key pool thread, so
+        # that an upload does not have to wait for the database first. Only
+        # when the pool has run dry is a row inserted here.
+        if self.keyPoolSize:
+            now = time.time()
+            with self.keyPoolLock:
+                if not self.keyFiller:
+                    # Started on first use rather than in __init__, which runs
+                    # before the server daemonizes.
+                    self.keyFiller = threading.Thread(target=self._fillKeyPool, name='keyPool', daemon=True)
+                    self.keyFiller.start()
+                reserved = None
+                while self.keyPool and not reserved:
+                    (id, key, created) = self.keyPool.popleft()
+                    if now - created < self.keyPoolMaxAge:
+                        reserved = (id, key)
+                    else:
+                        self.keyCounters['expired'] += 1
+                if len(self.keyPool) < self.keyPoolSize // 2:
+                    self.keysWanted.set()
+                self.keyCounters['taken' if reserved else 'fallbacks'] += 1
+            if reserved:
+                return reserved
+
+        attempt = 0
         while True:
-            with db.DatabaseCursor() as cursor:
-                key = ''.join(random.choice(string.ascii_letters + string.digits) for x in range(256))
-                try:
-                    cursor.execute('INSERT INTO `objects` (`key`, `uploading`) VALUES (%s, %s)', (key, True))
-                    id = cursor.lastrowid()
-                    break
-                except Exception as e:
-                    pass
-        return (id, key)
+            try:
+                return self._reserveKeys(1)[0]
+            except Exception as e:
+                attempt += 1
+                self.log.log(msg='Key reservation failed (attempt %d): %s' % (attempt, str(e)), context='UPLOAD')
+                if attempt == 5:
+                    raise
+                time.sleep(0.1 * 2 ** attempt)
+
+    def _fillKeyPool(self):
+        # Tops the pool up with one bulk insert whenever it has fallen below
+        # half of keyPoolSize. Reservations older than keyPoolMaxAge are
+        # dropped and not replaced until keys are asked for again; their rows
+        # are removed by the cleanup of stale uploads in sync, which allows
+        # for the time a key may have spent in the pool.
+        while True:
+            wanted = self.keysWanted.wait(timeout=self.keyPoolMaxAge / 2.0)
+            self.keysWanted.clear()
+            now = time.time()
+            with self.keyPoolLock:
+                while self.keyPool and now - self.keyPool[0][2] >= self.keyPoolMaxAge:
+                    self.keyPool.popleft()
+                    self.keyCounters['expired'] += 1
+                missing = self.keyPoolSize - len(self.keyPool)
+            if not wanted or missing <= 0:
+                continue
+
+            try:
+                reserved = self._reserveKeys(missing)
+            except Exception as e:
+                self.log.log(msg='Filling key pool failed: %s' % str(e), context='UPLOAD')
+                time.sleep(5)
+                self.keysWanted.set()
+                continue
+            with self.keyPoolLock:
+                self.keyPool.extend((id, key, now) for (id, key) in reserved)
+                self.keyCounters['reserved'] += len(reserved)
+
+    def _reserveKeys(self, count):
+        keys = [self._randomKey() for x in range(count)]
+        with db.DatabaseCursor() as cursor:
+            cursor.execute('INSERT INTO `objects` (`key`, `uploading`) VALUES %s' % ', '.join(['(%s, %s)'] * count), [value for key in keys for value in (key, True)])
+            if count == 1:
+                ids = {keys[0]: cursor.lastrowid()}
+            else:
+                # A multi-row insert is not guaranteed consecutive ids.
+                cursor.execute('SELECT `id`, `key` FROM `objects` WHERE `key` IN %s', (keys,))
+                ids = dict((obj['key'], obj['id']) for obj in cursor.fetchall())
+            self._journal(cursor, 'started', keys)
+        return [(ids[key], key) for key in keys]
+
+    def _randomKey(self):
+        key = b''
+        while len(key) < 256:
+            key += os.urandom(320).translate(self.keyTable, self.keyDrop)
+        return key[:256].decode('ascii')
+
+    def _lookup(self, key, user):
+        with db.DatabaseCursor() as cursor:
+            cursor.execute(self.selectObjects + ' WHERE `objects`.`key` = %s AND `objects`.`user` = %s AND `objects`.`uploading` = %s', (key, user, False))
+            items = list(cursor.fetchall())
+        return items[0] if len(items) == 1 else None
+
+    def _s3name(self, obj):
+        return self._blobName({'id': obj['blob'], 'hash': obj['hash']}) if obj.get('blob') else obj['key']
+
+    def _blobName(self, blob):
+        # The blob id is part of the name so that a blob that is re-created
+        # after being deleted never shares its S3 objects with the old one.
+        return '%s.%d' % (blob['hash'], blob['id'])
+
+    def _blobId(self, s3name):
+        try:
+            (digest, blobId) = s3name.split('.')
+            return int(blobId)
+        except ValueError:
+            return None
+
+    def _providers(self):
+        # Healthiest bucket first; sorted() is stable, so pri wins a tie.
+        return sorted(['pri', 'sec'], key=lambda provider: self.health[provider].score())
+
+    def _read(self, id, function, key, what, context):
+        # Asks the healthiest bucket first. If it fails, finds nothing, or has
+        # not answered within its hedgePercentile latency, the other bucket is
+        # asked as well and the first useful answer wins.
+        # A bucket whose circuit is open is only asked once there is nothing
+        # else left to try, so that hedges do not pile up on it.
+        # The hedge waits for the latency of lookups alone; part uploads and
+        # bulk deletes are much slower and would push it out of reach.
+        remaining = self._providers()
+        (first, probe) = (remaining[0], None)
+        for provider in remaining:
+            allowed = self.health[provider].allow()
+            if allowed:
+                (first, probe) = (provider, allowed)
+                break
+        remaining.remove(first)
+        delay = self.health[first].percentile(self.hedgePercentile, default=self.hedgeDelay, operation='get_key')
+        futures = {self.readPool.submit(self._attempt, probe, function, key, first): first}
+        pending = set(futures)
+        error = None
+        while pending:
+            (done, pending) = concurrent.futures.wait(pending, timeout=delay if remaining else None, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception():
+                    error = future.exception()
+                    self.log.log(msg='%s %s for %s failed: %s' % (self.names[futures[future]], what, id, str(error)), context=context)
+                elif future.result() is not None:
+                    return future.result()
+            allowed = self.health[remaining[0]].allow() if remaining else False
+            if allowed or (remaining and not pending):
+                provider = remaining.pop(0)
+                future = self.readPool.submit(self._attempt, allowed or None, function, key, provider)
+                futures[future] = provider
+                pending.add(future)
+        if error:
+            raise error
+        return None
+
+    def _attempt(self, probe, function, key, provider):
+        # Runs one read of _read() on the read pool. The first request it
+        # makes carries the probe ticket, if the circuit handed one out.
+        self.probes.ticket = (provider, probe)
+        try:
+            return function(key, provider)
+        finally:
+            self.probes.ticket = None
+
+    def _call(self, provider, function, *args, **kwargs):
+        labels = {'provider': provider, 'operation': function.__name__}
+        probe = getattr(self.probes, 'ticket', None)
+        if probe and probe[0] == provider:
+            self.probes.ticket = None
+            probe = probe[1]
+        else:
+            probe = None
+        start = time.time()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self.health[provider].record(time.time() - start, False, function.__name__, probe)
+            metrics.registry.observe('s3_request_seconds', labels, time.time() - start)
+            metrics.registry.increment('s3_request_errors_total', labels)
+            raise
+        self.health[provider].record(time.time() - start, True, function.__name__, probe)
+        metrics.registry.observe('s3_request_seconds', labels, time.time() - start)
+        return result
 
     def _key(self, key, provider):
-        return self.buckets[provider].get_key(key)
+        return self._call(provider, self.buckets[provider].get_key, key)
 
     def _retrieveKey(self, key, provider):
-        return self._key(key, provider).get_contents_as_string()
+        s3object = self._key(key, provider)
+        if s3object is None:
+            return None
+        return self._call(provider, s3object.get_contents_as_string)
 
     def _existsKey(self, key, provider):
         return self._key(key, provider) != None
 
+    def _copyKey(self, key, source, target):
+        # Streams the object straight from one bucket into the other: parts
+        # are uploaded while the next ones are still being downloaded.
+        s3object = self._key(key, source)
+        if s3object is None:
+            raise KeyError('%s is missing from %s' % (key, source))
+        try:
+            self._storeStream(key, s3object, [target])[target].result()
+        finally:
+            s3object.close(fast=True)
+
     def _storeKey(self, keyname, content, provider):
-        s3object = boto.s3.key.Key(bucket=self.buckets[provider])
-        s3object.key = keyname
-        s3object.set_contents_from_string(content)
+        s3object = self.buckets[provider].new_key(keyname)
+        self._call(provider, s3object.set_contents_from_string, content)
+
+    def _storeStream(self, keyname, fp, providers):
+        # Reads fp once, partSize bytes at a time, and uploads each part to all
+        # of the providers in parallel. At most uploadConcurrency parts per
+        # provider are in flight, which bounds the memory used by one stream.
+        # Returns a future per provider that resolves once its copy is stored.
+        # A seekable upload is instead read once per provider, each pass at
+        # the pace of its own bucket, so a slow bucket does not hold back the
+        # other one.
+        if len(providers) > 1 and fp.seekable():
+            start = fp.tell()
+            results = {}
+            for provider in providers:
+                results[provider] = concurrent.futures.Future()
+                threading.Thread(target=self._storePass, args=(keyname, SpoolReader(fp, start), provider, results[provider]), daemon=True).start()
+            return results
+
+        part = self._readPart(fp)
+        if len(part) < self.partSize:
+            return dict((provider, self.partPool.submit(self._storeKey, keyname, part, provider)) for provider in providers)
+
+        uploads = [MultipartUpload(self, keyname, provider) for provider in providers]
+        slots = threading.BoundedSemaphore(self.uploadConcurrency * len(uploads))
+        number = 1
+        try:
+            while part and not all(upload.error for upload in uploads):
+                for upload in uploads:
+                    upload.upload(number, part, slots)
+                number += 1
+                part = self._readPart(fp)
+        except Exception as e:
+            for upload in uploads:
+                upload.fail(e)
+        for upload in uploads:
+            upload.finish()
+        return dict((upload.provider, upload.result) for upload in uploads)
+
+    def _storePass(self, keyname, reader, provider, result):
+        try:
+            future = self._storeStream(keyname, reader, [provider])[provider]
+        except Exception as e:
+            result.set_exception(e)
+            return
+        finally:
+            reader.close()
+        future.add_done_callback(lambda future: result.set_exception(future.exception()) if future.exception() else result.set_result(future.result()))
+
+    def _readPart(self, fp):
+        # Network streams may return less than asked for before they end, and
+        # only the last part of a multipart upload is allowed to be short.
+        chunks = []
+        remaining = self.partSize
+        while remaining:
+            chunk = fp.read(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
 
-    def _deleteKey(self, key, provider):
-        s3object = self.buckets[provider].get_key(key)
-        s3object.delete()
+    def _deleteKeys(self, keys, provider):
+        result = self._call(provider, self.buckets[provider].delete_keys, keys, quiet=False)
+        deleted = [key.key for key in result.deleted]
+        errors = []
+        for error in result.errors:
+            if error.code == 'NoSuchKey':
+                deleted.append(error.key)
+            else:
+                errors.append((error.key, '%s: %s' % (error.code, error.message)))
+        return (deleted, errors)
 
-    def _listKeysBatch(self, provider, batch):
+    def _listKeysBatch(self, provider, batch, marker='', end=None):
+        # boto fetches the listing page by page while it is iterated, so the
+        # time it takes is measured per batch, without the caller's share.
         keys = []
-        for key in self._listKeys(provider):
+        start = time.time()
+        for key in self._listKeys(provider, marker):
+            if end and key.key >= end:
+                break
             keys.append(key.key)
             if len(keys) == batch:
+                metrics.registry.observe('s3_request_seconds', {'provider': provider, 'operation': 'list'}, time.time() - start)
                 yield(keys)
                 keys = []
+                start = time.time()
+        metrics.registry.observe('s3_request_seconds', {'provider': provider, 'operation': 'list'}, time.time() - start)
         yield(keys)
 
-    def _listKeys(self, provider):
-        return self.buckets[provider].list()
+    def _listKeys(self, provider, marker=''):
+        return self.buckets[provider].list(marker=marker)
 
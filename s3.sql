@@ -9,12 +9,74 @@ CREATE TABLE `objects` (
   `uploading` tinyint(1) NOT NULL DEFAULT '0',
   `created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
   `deleteAfter` datetime DEFAULT NULL,
-  `user` text CHARACTER SET utf8 COLLATE utf8_bin,
+  `user` varchar(255) CHARACTER SET utf8 COLLATE utf8_bin DEFAULT NULL,
   `name` text CHARACTER SET utf8 COLLATE utf8_bin,
   `mimeType` text CHARACTER SET utf8 COLLATE utf8_bin,
+  `codec` varchar(16) CHARACTER SET ascii DEFAULT NULL,
   `pri` tinyint(1) NOT NULL DEFAULT '0',
   `sec` tinyint(1) NOT NULL DEFAULT '0',
+  `blob` int(11) DEFAULT NULL,
   PRIMARY KEY (`id`),
-  UNIQUE KEY `handle` (`key`) USING BTREE
+  UNIQUE KEY `handle` (`key`) USING BTREE,
+  KEY `blob` (`blob`),
+  KEY `deleteAfter` (`deleteAfter`),
+  KEY `userObjects` (`user`,`uploading`,`deleteAfter`,`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
 
+--
+-- Table structure for table `journal`
+--
+
+DROP TABLE IF EXISTS `journal`;
+CREATE TABLE `journal` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `key` varchar(256) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL,
+  `event` enum('started','completed','deleted','replicated') NOT NULL,
+  `created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  KEY `event` (`event`,`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
+
+--
+-- Table structure for table `syncState`
+--
+
+DROP TABLE IF EXISTS `syncState`;
+CREATE TABLE `syncState` (
+  `name` varchar(64) NOT NULL,
+  `value` text CHARACTER SET utf8 COLLATE utf8_bin,
+  `updated` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
+
+
+--
+-- Table structure for table `blobs`
+--
+
+DROP TABLE IF EXISTS `blobs`;
+CREATE TABLE `blobs` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `hash` char(64) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+  `refs` int(11) NOT NULL DEFAULT '0',
+  `created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `pri` tinyint(1) NOT NULL DEFAULT '0',
+  `sec` tinyint(1) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `hash` (`hash`),
+  KEY `refs` (`refs`),
+  KEY `replicas` (`pri`,`sec`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
+
+--
+-- Table structure for table `syncLeases`
+--
+
+DROP TABLE IF EXISTS `syncLeases`;
+CREATE TABLE `syncLeases` (
+  `name` varchar(64) NOT NULL,
+  `owner` varchar(128) CHARACTER SET utf8 COLLATE utf8_bin DEFAULT NULL,
+  `expires` datetime DEFAULT NULL,
+  `finished` datetime DEFAULT NULL,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
@@ -2,8 +2,17 @@
 
 import os, sys
 import cherrypy
+import datetime
+import decimal
+import json
+import cherrypy.lib.httputil
+import urllib.parse
 
+import cache
+import db
+import health
 import init
+import metrics
 import openid
 import s3
 
@@ -28,22 +37,41 @@ class API():
             self.api = api
 
         @cherrypy.tools.json_out(handler=dumper)
-        def GET(self):
+        def GET(self, limit=None, cursor=None):
             user = self.api.openid.validateAccessToken('s3')
             if not user:
                 raise cherrypy.HTTPError(403)
-            return self.api.s3.list(user)
+            if limit is None and cursor is None:
+                return self.api.s3.list(user)
+
+            try:
+                return self.api.s3.listPage(user, limit=limit or 100, cursor=cursor)
+            except ValueError:
+                raise cherrypy.HTTPError(400)
 
     class Object():
         def __init__(self, api):
             self.api = api
 
         @cherrypy.tools.json_out()
-        def GET(self, key):
+        def GET(self, key, presign=None):
             user = self.api.openid.validateAccessToken('s3')
             if not user:
                 raise cherrypy.HTTPError(403)
 
+            # In presign mode the client may fetch the content from S3 itself,
+            # either by asking for the URL or by following a redirect to it.
+            if presign is not None:
+                if not self.api.presign or presign not in ('url', 'redirect'):
+                    raise cherrypy.HTTPError(400)
+                location = self.api.s3.presignDownload(key, user)
+                if not location:
+                    raise cherrypy.HTTPError(404)
+                cherrypy.log(msg='%s/%s' % (user, key[:16]), context='PRESIGN-GET')
+                if presign == 'redirect':
+                    raise cherrypy.HTTPRedirect(location['url'], 302)
+                return location
+
             content = self.api.s3.get(key, user)
             if not content:
                 raise cherrypy.HTTPError(500)
@@ -63,15 +91,195 @@ class API():
             cherrypy.log(msg='%s/%s' % (user, vpath[0][:16]), context='DELETE')
             return
 
+    class Download():
+        _cp_config = {'response.stream': True,
+                      'tools.gzip.on': False}
+
+        def __init__(self, api):
+            self.api = api
+
+        def GET(self, key):
+            user = self.api.openid.validateAccessToken('s3')
+            if not user:
+                raise cherrypy.HTTPError(403)
+
+            s3object = self.api.s3.open(key, user)
+            if not s3object:
+                raise cherrypy.HTTPError(404)
+
+            request = cherrypy.request
+            response = cherrypy.response
+            size = s3object['size']
+            response.headers['Content-Type'] = s3object['mimeType'] or 'application/octet-stream'
+            response.headers['Content-Disposition'] = 'attachment; filename*=UTF-8\'\'%s' % urllib.parse.quote(s3object['name'] or key[:16])
+            response.headers['Cache-Control'] = 'private'
+
+            # Compressed objects go out in their stored form to clients that
+            # take gzip, and are decompressed on the fly for everybody else.
+            etag = s3object['etag']
+            decode = False
+            if s3object['codec']:
+                response.headers['Vary'] = 'Accept-Encoding'
+                if [coding for coding in request.headers.elements('Accept-Encoding') if coding.value in ('gzip', 'x-gzip', '*') and coding.qvalue > 0]:
+                    response.headers['Content-Encoding'] = s3object['codec']
+                    etag = '%s-%s"' % (etag[:-1], s3object['codec'])
+                else:
+                    decode = True
+            response.headers['ETag'] = etag
+
+            etags = [etag.strip().replace('W/', '', 1) for etag in request.headers.get('If-None-Match', '').split(',')]
+            if response.headers['ETag'] in etags or '*' in etags:
+                response.status = 304
+                return None
+
+            if decode:
+                # The decoded length is not known up front, so ranges are not
+                # offered for it; the body goes out chunked.
+                cherrypy.log(msg='%s/%s' % (user, key[:16]), context='DOWNLOAD')
+                return self.api.s3.streamDecoded(s3object)
+            response.headers['Accept-Ranges'] = 'bytes'
+
+            ranges = None
+            if request.headers.get('Range'):
+                ranges = cherrypy.lib.httputil.get_ranges(request.headers['Range'], size)
+                if ranges == []:
+                    response.headers['Content-Range'] = 'bytes */%d' % size
+                    raise cherrypy.HTTPError(416)
+
+            cherrypy.log(msg='%s/%s' % (user, key[:16]), context='DOWNLOAD')
+            # Multiple ranges would need a multipart/byteranges body; the whole
+            # object is an allowed answer to those, so only one range is honoured.
+            if ranges and len(ranges) == 1:
+                (start, stop) = ranges[0]
+                response.status = 206
+                response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+                response.headers['Content-Length'] = stop - start
+                return self.api.s3.stream(s3object, start, stop - 1)
+            response.headers['Content-Length'] = size
+            return self.api.s3.stream(s3object)
+
+    class Batch():
+        # Bulk versions of Upload.PUT, Object.DELETE and Download.GET, for
+        # clients that handle many objects at once. Every request carries a
+        # JSON object with a list of up to batchLimit keys.
+        class Store():
+            def __init__(self, api):
+                self.api = api
+
+            @cherrypy.tools.json_in()
+            @cherrypy.tools.json_out()
+            def POST(self):
+                user = self.api.openid.validateAccessToken('s3')
+                if not user:
+                    raise cherrypy.HTTPError(403)
+
+                keys = self.api.batchKeys()
+                result = self.api.s3.storeFiles(keys, user)
+                cherrypy.log(msg='%s: %d keys' % (user, len(keys)), context='BATCH-STORE')
+                return {'items': result}
+
+        class Delete():
+            def __init__(self, api):
+                self.api = api
+
+            @cherrypy.tools.json_in()
+            @cherrypy.tools.json_out()
+            def POST(self):
+                user = self.api.openid.validateAccessToken('s3')
+                if not user:
+                    raise cherrypy.HTTPError(403)
+
+                keys = self.api.batchKeys()
+                result = self.api.s3.deleteObjects(user, keys)
+                cherrypy.log(msg='%s: %d keys' % (user, len(keys)), context='BATCH-DELETE')
+                return {'items': result}
+
+        class Download():
+            _cp_config = {'response.stream': True,
+                          'tools.gzip.on': False}
+
+            def __init__(self, api):
+                self.api = api
+
+            @cherrypy.tools.json_in()
+            def POST(self):
+                user = self.api.openid.validateAccessToken('s3')
+                if not user:
+                    raise cherrypy.HTTPError(403)
+
+                keys = self.api.batchKeys()
+                response = cherrypy.response
+                response.headers['Content-Type'] = 'application/x-tar'
+                response.headers['Content-Disposition'] = 'attachment; filename="objects.tar"'
+                response.headers['Cache-Control'] = 'private'
+                cherrypy.log(msg='%s: %d keys' % (user, len(keys)), context='BATCH-DOWNLOAD')
+                return self.api.s3.archive(keys, user)
+
+        def __init__(self, api):
+            self.store = self.Store(api)
+            self.store.exposed = True
+            self.delete = self.Delete(api)
+            self.delete.exposed = True
+            self.download = self.Download(api)
+            self.download.exposed = True
+
+    class Stats():
+        def __init__(self, api):
+            self.api = api
+
+        @cherrypy.tools.json_out()
+        def GET(self):
+            user = self.api.openid.validateAccessToken('s3')
+            if not user:
+                raise cherrypy.HTTPError(403)
+            return self.api.s3.statistics()
+
+    class Metrics():
+        def __init__(self, api):
+            self.api = api
+
+        def GET(self):
+            # Scraped by Prometheus, which needs an access token like any other
+            # client. Pool and cache figures are read at scrape time,
+            # everything else is recorded as it happens.
+            user = self.api.openid.validateAccessToken('s3')
+            if not user:
+                raise cherrypy.HTTPError(403)
+            registry = metrics.registry
+            for (kind, value) in (db.statistics() or {}).items():
+                registry.set('db_pool', {'kind': kind}, value)
+            if self.api.s3.cache:
+                for (kind, value) in self.api.s3.cache.statistics().items():
+                    registry.set('object_cache', {'kind': kind}, value)
+            for provider in ['pri', 'sec']:
+                registry.set('s3_provider_available', {'provider': provider}, int(self.api.s3.health[provider].available()))
+            cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+            return registry.render()
+
     class Upload():
         def __init__(self, api):
             self.api = api
 
+        @cherrypy.tools.json_out()
+        def GET(self, name=None, mimeType=None):
+            # Presign mode: the client uploads the content straight to S3 with
+            # the returned request and then confirms it with PUT as usual.
+            user = self.api.openid.validateAccessToken('s3')
+            if not user:
+                raise cherrypy.HTTPError(403)
+            if not self.api.presign:
+                raise cherrypy.HTTPError(404)
+
+            upload = self.api.s3.presignUpload(name, mimeType)
+            cherrypy.log(msg='%s/%s' % (user, upload['key'][:16]), context='PRESIGN-PUT')
+            return upload
+
         def POST(self, upload):
             name = upload.filename
-            content = upload.file.read()
             mimeType = str(upload.content_type)
-            key = self.api.s3.receiveFile(name, content, mimeType)
+            key = self.api.s3.receiveStream(name, upload.file, mimeType)
+            if not key:
+                raise cherrypy.HTTPError(500)
 
             text = '<span id="key">%s</span>' % key
             text += '<script type="text/javascript">parent.$(\'body\').trigger(\'iframeLoaded\');</script>';
@@ -88,27 +296,89 @@ class API():
             if 'key' not in request:
                 raise cherrypy.HTTPError(400)
 
+            if not self.api.s3.confirmUpload(request['key']):
+                raise cherrypy.HTTPError(409)
             self.api.s3.storeFile(request['key'], user)
             cherrypy.log(msg='%s/%s' % (user, request['key'][:16]), context='UPLOAD2')
 
     def __init__(self):
         self.openid = openid.OpenID('s3')
+        self.presign = cherrypy.config.get('s3.presign', False)
+        self.batchLimit = cherrypy.config.get('s3.batchLimit', 1000)
+        providerHealth = dict((provider, health.ProviderHealth(window=cherrypy.config.get('s3.health.window', 60),
+                                                               failureRate=cherrypy.config.get('s3.health.failureRate', 0.5),
+                                                               minRequests=cherrypy.config.get('s3.health.minRequests', 10),
+                                                               openTime=cherrypy.config.get('s3.health.openTime', 30)))
+                              for provider in ['pri', 'sec'])
+        db.configurePool(init.Init.databaseParameters()['parameters'],
+                         size=cherrypy.config.get('database.poolSize', 20),
+                         idleCheck=cherrypy.config.get('database.idleCheck', 30))
+        objectCache = None
+        if cherrypy.config.get('s3.cache.memorySize') or cherrypy.config.get('s3.cache.diskSize'):
+            objectCache = cache.ObjectCache(memorySize=cherrypy.config.get('s3.cache.memorySize', 0),
+                                            diskSize=cherrypy.config.get('s3.cache.diskSize', 0),
+                                            directory=cherrypy.config.get('s3.cache.directory'),
+                                            maxObjectSize=cherrypy.config.get('s3.cache.maxObjectSize', 16777216))
         self.s3 = s3.S3Sync(pri={'region': cherrypy.config['s3.pri.region'],
                                  'bucket': cherrypy.config['s3.pri.bucket'],
                                  'access': cherrypy.config['s3.pri.access'],
-                                 'secret': cherrypy.config['s3.pri.secret']},
+                                 'secret': cherrypy.config['s3.pri.secret'],
+                                 'concurrency': cherrypy.config.get('s3.pri.concurrency', 8)},
                             sec={'region': cherrypy.config['s3.sec.region'],
                                  'bucket': cherrypy.config['s3.sec.bucket'],
                                  'access': cherrypy.config['s3.sec.access'],
-                                 'secret': cherrypy.config['s3.sec.secret']},
-                            log=cherrypy.log)
+                                 'secret': cherrypy.config['s3.sec.secret'],
+                                 'concurrency': cherrypy.config.get('s3.sec.concurrency', 8)},
+                            log=cherrypy.log,
+                            chunkSize=cherrypy.config.get('s3.chunkSize', 1048576),
+                            partSize=cherrypy.config.get('s3.partSize', 8388608),
+                            uploadConcurrency=cherrypy.config.get('s3.uploadConcurrency', 4),
+                            uploadThreads=cherrypy.config.get('s3.uploadThreads', 16),
+                            replication=cherrypy.config.get('s3.replication', 'async'),
+                            syncThreads=cherrypy.config.get('s3.syncThreads', 16),
+                            syncBudget=cherrypy.config.get('s3.syncBudget', 50),
+                            syncBatch=cherrypy.config.get('s3.syncBatch', 1000),
+                            syncMode=cherrypy.config.get('s3.syncMode', 'full'),
+                            reconcileInterval=cherrypy.config.get('s3.reconcileInterval', 86400),
+                            syncShards=cherrypy.config.get('s3.syncShards', 1),
+                            syncLeaseTime=cherrypy.config.get('s3.syncLeaseTime', 120),
+                            keyPoolSize=cherrypy.config.get('s3.keyPoolSize', 100),
+                            keyPoolMaxAge=cherrypy.config.get('s3.keyPoolMaxAge', 300),
+                            listLimit=cherrypy.config.get('s3.listLimit', 1000),
+                            dedup=cherrypy.config.get('s3.dedup', False),
+                            compressTypes=cherrypy.config.get('s3.compressTypes', []),
+                            compressLevel=cherrypy.config.get('s3.compressLevel', 6),
+                            presignExpiry=cherrypy.config.get('s3.presignExpiry', 300),
+                            readThreads=cherrypy.config.get('s3.readThreads', 16),
+                            batchThreads=cherrypy.config.get('s3.batchThreads', 8),
+                            hedgePercentile=cherrypy.config.get('s3.hedgePercentile', 95),
+                            hedgeDelay=cherrypy.config.get('s3.hedgeDelay', 0.5),
+                            cache=objectCache,
+                            providerHealth=providerHealth)
 
         self.list = self.List(self)
         self.list.exposed = True
         self.object = self.Object(self)
         self.object.exposed = True
+        self.download = self.Download(self)
+        self.download.exposed = True
+        self.stats = self.Stats(self)
+        self.stats.exposed = True
+        self.metrics = self.Metrics(self)
+        self.metrics.exposed = True
         self.upload = self.Upload(self)
         self.upload.exposed = True
+        self.batch = self.Batch(self)
+        self.batch.exposed = True
+
+    def batchKeys(self):
+        request = cherrypy.request.json
+        keys = request.get('keys') if isinstance(request, dict) else None
+        if not isinstance(keys, list) or not keys or not all(isinstance(key, str) for key in keys):
+            raise cherrypy.HTTPError(400)
+        if len(keys) > self.batchLimit:
+            raise cherrypy.HTTPError(413)
+        return keys
 
 def main():
     service = init.Init('s3', __file__)